@@ -1,6 +1,24 @@
-from fastapi import FastAPI
+import os
+import time
+import uuid
+import asyncio
+from typing import Awaitable
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import StreamingResponse, RedirectResponse
-from main_graph import graph
+from langchain_core.documents import Document
+from sse_starlette.sse import EventSourceResponse
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+from main_graph import graph_builder, graph, summarize
+from nodes.retriever import preload_guideline_stores
+from nodes.llm_doc_filter import preload_split_stores
+from response_cache import SemanticResponseCache
+from metrics import metrics, TokenUsage
+from singleflight import SingleFlight
+from summaries import ConversationSummaries
+from nodes.query_embeddings import normalize_query
+from constants import RESPONSE_CACHE_ENABLED, STREAM_COALESCE_SECONDS, STREAM_COALESCE_CHARS, DISCONNECT_POLL_SECONDS
+from constants import SESSION_CHECKPOINT_PATH, SCHEDULER
 import json
 from fastapi.middleware.cors import CORSMiddleware
 from os import getenv
@@ -11,32 +29,242 @@ origins = [
     getenv('FRONTEND_URL'),
 ]
 
-async def run_graph(input: dict):
-    curr_node = ''
-    last_node = ''
-    content_to_stream = ''
-    async for output in graph.astream_log(input, include_types=['llm']):
-        for op in output.ops:
-            if isinstance(op['value'], dict) and 'metadata' in op['value'] and 'langgraph_node' in op['value']['metadata']:
-                curr_node = op['value']['metadata']['langgraph_node']
-            elif op["path"][:6] == "/logs/" and op["path"][-18:] == "/streamed_output/-" and curr_node == 'chat':
-                content_to_stream = op["value"].content
-            elif op["path"] == "/streamed_output/-":
-                if curr_node == 'summarizer':
-                    content_to_stream = op['value']['summarizer']['sources']
-                elif curr_node == 'filter':
-                    try:
-                        content_to_stream = [{'page_content': c.page_content, 'metadata': c.metadata} for c in op['value']['filter']['filtered_retrieved']]
-                    except:
-                        curr_node = ''
-            if curr_node != last_node:
-                yield json.dumps({'node': curr_node})+'\n'
-                last_node = curr_node
-            if content_to_stream:
-                yield json.dumps({'content': content_to_stream})+'\n'
-                content_to_stream = ''
-
-app = FastAPI()
+response_cache = SemanticResponseCache() if RESPONSE_CACHE_ENABLED else None
+# identical questions asked at the same time share one graph run
+flights = SingleFlight()
+summaries = ConversationSummaries()
+# replaced in lifespan by a graph with a checkpointer, which keeps each conversation's state between turns;
+# the graph itself always runs statelessly, on the state passed in, so runs can be shared across conversations
+session_graph = graph
+# what a follow-up turn needs from the previous one, besides the summary
+SESSION_KEYS = ('retrieval_topic', 'use_guidelines', 'filtered_retrieved')
+
+def thread_config(conversation_id: str):
+    return {'configurable': {'thread_id': conversation_id}}
+
+# --- streaming protocol ---
+# typed events, in order:
+#   {'event': 'node_start', 'node': ...}     {'event': 'node_end', 'node': ...}
+#   {'event': 'documents', 'documents': [{'id', 'page_content', 'metadata'}, ...]}   the numbered <doc_#> sources
+#   {'event': 'sources', 'sources': ...}     formatted reference list
+#   {'event': 'token', 'content': ...}       chat answer text, coalesced
+#   {'event': 'done', 'stats': {...}, 'use_guidelines': ..., 'conversation_id': ...}
+# the updated conversation summary is written after 'done', for GET /summary/{conversation_id}
+
+def graph_node(event: dict):
+    # the graph's own node runs, not the runnables and edge functions running inside them
+    node = event['metadata'].get('langgraph_node')
+    return node if node == event['name'] and len(event['parent_ids']) == 1 and not node.startswith('__') else None
+
+async def raw_graph_events(input: dict, config: dict = None):
+    stats = {}
+    use_guidelines = False
+    _input = {'prompt': input['prompt'], 'summary': input['summary'], **input.get('session', {})}
+    async for event in graph.astream_events(_input, config, version='v2'):
+        if event['event'] == 'on_chat_model_stream':
+            message = event['data']['chunk']
+            if event['metadata'].get('langgraph_node') == 'chat' and message.content:
+                yield {'event': 'token', 'content': message.content}
+        elif event['event'] == 'on_chain_start' and graph_node(event):
+            yield {'event': 'node_start', 'node': graph_node(event)}
+        elif event['event'] == 'on_chain_end' and graph_node(event):
+            update = event['data'].get('output')
+            update = update if isinstance(update, dict) else {}
+            if update.get('filtered_retrieved') is not None:
+                yield {'event': 'documents', 'documents': [{'id': d.id, 'page_content': d.page_content, 'metadata': d.metadata} for d in update['filtered_retrieved']]}
+            if update.get('sources') is not None:
+                yield {'event': 'sources', 'sources': update['sources']}
+            stats.update(update.get('stats') or {})
+            use_guidelines = update.get('use_guidelines', use_guidelines)
+            yield {'event': 'node_end', 'node': graph_node(event)}
+    yield {'event': 'done', 'stats': stats, 'use_guidelines': use_guidelines}
+
+def token_event(buffer: list[str]):
+    return {'event': 'token', 'content': ''.join(buffer)}
+
+async def graph_events(input: dict, config: dict = None, window: float = STREAM_COALESCE_SECONDS, max_chars: int = STREAM_COALESCE_CHARS):
+    """ raw_graph_events, with runs of tokens merged until `window` seconds or `max_chars` characters """
+    events = raw_graph_events(input, config)
+    buffer, deadline = [], 0.
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(events.__anext__())
+            # a half-full buffer still goes out when its window closes, even if the model has stalled
+            done, _ = await asyncio.wait({pending}, timeout=max(0., deadline - time.monotonic()) if buffer else None)
+            if not done:
+                yield token_event(buffer)
+                buffer = []
+                continue
+            next_event, pending = pending, None
+            try:
+                event = next_event.result()
+            except StopAsyncIteration:
+                break
+            if event['event'] == 'token':
+                if not buffer:
+                    deadline = time.monotonic() + window
+                buffer.append(event['content'])
+                if time.monotonic() < deadline and sum(map(len, buffer)) < max_chars:
+                    continue
+            if buffer:
+                yield token_event(buffer)
+                buffer = []
+            if event['event'] != 'token':
+                yield event
+        if buffer:
+            yield token_event(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        await events.aclose()
+
+def replayed_state(prompt: str, events: list[dict], session: dict = None):
+    """ The retrieval state of a turn, rebuilt from its events, for its conversation's checkpoint """
+    done = events[-1]
+    documents = [Document(page_content=d['page_content'], metadata=d['metadata'], id=d.get('id'))
+                 for e in events if e['event'] == 'documents' for d in e['documents']]
+    state = {'prompt': prompt, 'use_guidelines': done['use_guidelines'], 'guiding_prompt': '', 'algo_recs': {},
+             'response': ''.join(e['content'] for e in events if e['event'] == 'token')}
+    if done['use_guidelines']:
+        # a turn that reused the previous retrieval keeps its topic
+        reused = (done['stats'].get('session') or {}).get('reused')
+        topic = (session or {}).get('retrieval_topic') if reused else None
+        state.update({'filtered_retrieved': documents, 'source_ids': [d.id for d in documents], 'retrieval_topic': topic or prompt})
+    return state
+
+async def cached_graph_events(input: dict, config: dict = None):
+    if response_cache is None:
+        async for event in graph_events(input, config):
+            yield event
+        return
+    prompt, summary = input['prompt'], input.get('summary', '')
+    cached = await response_cache.alookup(prompt, summary)
+    if cached is not None:
+        for event in cached:
+            if event['event'] == 'done':
+                # the stored run's stats (filter calls, router path, packing) aren't this request's
+                event = {**event, 'stats': {'response_cache': 'hit'}}
+            yield event
+        return
+    events = []
+    async for event in graph_events(input, config):
+        events.append(event)
+        yield event
+    # only reached if the whole answer streamed
+    await response_cache.astore(prompt, summary, events)
+
+async def metered_graph_events(input: dict, usage: TokenUsage):
+    async for event in cached_graph_events(input, {'callbacks': [usage]}):
+        if event['event'] == 'done':
+            event = {**event, 'stats': {**event['stats'], 'tokens': usage.report()}}
+        yield event
+    if usage.total:  # replayed answers cost nothing
+        metrics.incr('requests.completed')
+        metrics.incr('tokens.completed_requests', usage.total)
+
+def flight_key(input: dict):
+    # everything the run depends on; a first question asked from many conversations at once shares one run
+    session = input.get('session') or {}
+    return (normalize_query(input['prompt']), normalize_query(input['summary']), session.get('retrieval_topic'),
+            session.get('use_guidelines'), tuple(d.id for d in session.get('filtered_retrieved') or []))
+
+async def session_input(input: dict):
+    """ The request, with its conversation_id, the conversation's summary so far and its checkpointed state filled in """
+    conversation_id = input.get('conversation_id') or uuid.uuid4().hex
+    summary = input.get('summary')
+    if summary is None:
+        # waits for the previous turn's summary if it's still being written
+        summary = await summaries.get(conversation_id)
+    session = {}
+    if session_graph is not graph:
+        values = (await session_graph.aget_state(thread_config(conversation_id))).values
+        summary = values.get('summary') if summary is None else summary
+        session = {k: values[k] for k in SESSION_KEYS if values.get(k) is not None}
+    return {**input, 'conversation_id': conversation_id, 'summary': summary or '', 'session': session}
+
+async def store_summary(conversation_id: str, summary: Awaitable[str]):
+    # the summary is shared by the flight; one conversation going away mustn't cancel it for the others
+    summary = await asyncio.shield(summary)
+    if session_graph is not graph:
+        await session_graph.aupdate_state(thread_config(conversation_id), {'summary': summary}, as_node='chat')
+    return summary
+
+async def request_events(request: Request, input: dict, poll: float = DISCONNECT_POLL_SECONDS):
+    """ Graph events for one request; the graph is cancelled, LLM calls and all, once every client asking has gone """
+    usage = TokenUsage()
+    input = await session_input(input)
+    conversation_id = input['conversation_id']
+    response = []
+    flight, joined = flights.join(flight_key(input), lambda: metered_graph_events(input, usage), lambda: record_cancelled(usage))
+    metrics.incr('requests.coalesced' if joined else 'requests.started')
+    index = 0
+    try:
+        while True:
+            try:
+                event = await flight.next(index, poll)
+            except asyncio.TimeoutError:
+                # nothing is written while the graph works, so a dropped connection only shows up here
+                if await request.is_disconnected():
+                    return
+                continue
+            except StopAsyncIteration:
+                return
+            index += 1
+            if event['event'] == 'token':
+                response.append(event['content'])
+            elif event['event'] == 'done':
+                event = {**event, 'conversation_id': conversation_id}
+                if session_graph is not graph:
+                    # the run was stateless, so leave this conversation's checkpoint where its own run would have
+                    await session_graph.aupdate_state(thread_config(conversation_id),
+                                                      replayed_state(input['prompt'], flight.events[:index], input['session']), as_node='chat')
+                if 'summary' not in flight.shared:
+                    # every subscriber asked the same thing with the same summary, so one new summary serves them all
+                    flight.shared['summary'] = asyncio.ensure_future(
+                        summarize(input['prompt'], ''.join(response), input['summary'], event['use_guidelines']))
+                summaries.start(conversation_id, store_summary(conversation_id, flight.shared['summary']))
+            yield event
+    finally:
+        flight.leave()
+
+def record_cancelled(usage: TokenUsage):
+    snapshot = metrics.snapshot()
+    completed = snapshot.get('requests.completed', 0)
+    expected = snapshot.get('tokens.completed_requests', 0) / completed if completed else 0
+    metrics.incr('requests.cancelled')
+    metrics.incr('tokens.cancelled_requests', usage.total)
+    # rough: an average completed request's tokens, less what this one had already spent
+    metrics.incr('tokens.saved_estimate', max(0, expected - usage.total))
+
+async def run_graph(request: Request, input: dict):
+    async for event in request_events(request, input):
+        yield json.dumps(event)+'\n'
+
+async def run_graph_sse(request: Request, input: dict):
+    async for event in request_events(request, input):
+        yield {'event': event['event'], 'data': json.dumps(event)}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global session_graph
+    # warm the guideline stores in the background; the worker starts serving straight away
+    preload_guideline_stores()
+    preload_split_stores()
+    if SESSION_CHECKPOINT_PATH is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(SESSION_CHECKPOINT_PATH) or '.', exist_ok=True)
+    async with AsyncSqliteSaver.from_conn_string(SESSION_CHECKPOINT_PATH) as checkpointer:
+        session_graph = graph_builder.compile(checkpointer=checkpointer)
+        yield
+        # summaries write to the checkpointer, so they have to finish before it closes
+        await summaries.drain()
+        session_graph = graph
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -48,9 +276,27 @@ app.add_middleware(
 async def redirect_root_to_docs():
     return RedirectResponse("/docs")
 
+@app.get("/metrics")
+async def read_metrics():
+    return {**metrics.snapshot(), **SCHEDULER.snapshot()}
+
+@app.get("/summary/{conversation_id}")
+async def read_summary(conversation_id: str):
+    summary = await summaries.get(conversation_id)
+    if summary is None and session_graph is not graph:
+        # evicted from memory, or written by another worker or before a restart
+        summary = (await session_graph.aget_state(thread_config(conversation_id))).values.get('summary')
+    if summary is None:
+        raise HTTPException(status_code=404, detail='Unknown conversation')
+    return {'conversation_id': conversation_id, 'summary': summary}
+
 @app.post("/chat")
-async def read_item(input: dict):
-    return StreamingResponse(run_graph(input))
+async def read_item(request: Request, input: dict):
+    return StreamingResponse(run_graph(request, input), media_type='application/x-ndjson')
+
+@app.post("/chat/sse")
+async def read_item_sse(request: Request, input: dict):
+    return EventSourceResponse(run_graph_sse(request, input))
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,207 @@
+import os
+from dotenv import load_dotenv
+load_dotenv()
+if os.getenv('OPENAI_APIKEY'):
+    os.environ['OPENAI_API_KEY'] = os.getenv('OPENAI_APIKEY')
+
+import json
+import asyncio
+import hashlib
+import pickle
+import argparse
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from langchain_text_splitters import MarkdownHeaderTextSplitter
+from langchain_community.vectorstores import FAISS
+
+from nodes.splits import headers_to_split_on, build_splits
+from nodes.docstore import convert_pickles
+from constants import EMBD, GUIDELINES
+
+# Offline build of the guideline stores under guideline_pkls/<guideline>:
+#   python build_index.py cua --markdown cua=guidelines/cua.md    (chunk, embed and index a cleaned guideline)
+#   python build_index.py                                          (refresh splits + split embeddings for every guideline)
+# The pkl files are then packed into guideline_pkls/<guideline>/docstore.sqlite, which is what the server reads.
+# Embeddings are reused for any chunk, summary or split whose content is unchanged since the last build,
+# so a guideline update only pays for the sections that actually changed. Vectors are only reused from a build
+# by the same embedding model (manifest.json); a store without a manifest has one of its texts re-embedded to check.
+#
+# Summaries are still produced outside this repo. A rebuild keeps them: a chunk whose content matches a
+# parent of the previous build keeps that parent's indexed summaries, and the RAPTOR parents (no 'Header 1')
+# are carried over as they are, with a warning since they may now summarize changed sections.
+# New or changed chunks are indexed as themselves until their summaries are regenerated.
+# Use the same --depth as the previous build, or no chunk will match its old parent.
+
+EMBEDDING_BATCH_SIZE = 128
+EMBEDDING_CONCURRENCY = 4
+
+
+def content_hash(doc: Document):
+    key = f'{sorted(doc.metadata.items())}\n{doc.page_content}'
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def chunk_markdown(text: str, depth: int):
+    # headers below `depth` stay inside the chunk, for the document filter to split on later
+    splitter = MarkdownHeaderTextSplitter(headers_to_split_on=headers_to_split_on[:depth], strip_headers=False)
+    chunks = {}
+    for c in splitter.split_text(text):
+        chunks.setdefault(content_hash(c), c)
+    return chunks
+
+async def embed_texts(texts: list[str], batch_size=EMBEDDING_BATCH_SIZE, concurrency=EMBEDDING_CONCURRENCY):
+    # EMBD goes through the scheduler, which already retries rate limits and transient errors
+    semaphore = asyncio.Semaphore(concurrency)
+    async def embed_batch(batch):
+        async with semaphore:
+            return await EMBD.aembed_documents(batch)
+    batches = [texts[i:i+batch_size] for i in range(0, len(texts), batch_size)]
+    results = await asyncio.gather(*[embed_batch(b) for b in batches])
+    return [np.asarray(v, dtype=np.float32) for r in results for v in r]
+
+
+def load_manifest(directory):
+    path = f'{directory}/manifest.json'
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        manifest = json.load(file)
+    # vectors from another embedding model can't be mixed in
+    return manifest if manifest.get('embedding_model') == EMBD.model else {}
+
+def save_manifest(directory, manifest):
+    with open(f'{directory}/manifest.json', 'w') as file:
+        json.dump(manifest, file, indent=2)
+
+def text_hash(text: str):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+async def same_embedding_model(text: str, vector: np.ndarray):
+    # a store without a (matching) manifest: its vectors are reused if re-embedding one of its texts gives the same vector
+    probe, = await embed_texts([text])
+    same = probe.shape == vector.shape and float(probe @ vector / (np.linalg.norm(probe) * np.linalg.norm(vector))) > 0.99
+    print(f'no manifest for this embedding model; the existing FAISS vectors are {"reused" if same else "from another model, re-embedding"}')
+    return same
+
+async def previous_build(directory, manifest):
+    """ The last build's parents with their indexed children, and the children's vectors when they can be reused """
+    if not os.path.exists(f'{directory}/faiss/index.pkl'):
+        return {}, {}
+    with open(f'{directory}/doc_ids.pkl', 'rb') as file:
+        doc_ids = pickle.load(file)
+    with open(f'{directory}/docs.pkl', 'rb') as file:
+        docs = pickle.load(file)
+    with open(f'{directory}/faiss/index.pkl', 'rb') as file:
+        faiss_docstore, index_to_docstore_id = pickle.load(file)
+    index = faiss.read_index(f'{directory}/faiss/index.faiss')
+    children = [faiss_docstore.search(index_to_docstore_id[i]) for i in range(index.ntotal)]
+    vectors = {text_hash(c.page_content): v for c, v in zip(children, index.reconstruct_n(0, index.ntotal))} if children else {}
+    if vectors and not manifest and not await same_embedding_model(children[0].page_content, vectors[text_hash(children[0].page_content)]):
+        vectors = {}
+    families = {}
+    for c in children:
+        families.setdefault(c.metadata.get('doc_id'), []).append(c)
+    return {doc_id: (doc, families.get(doc_id, [])) for doc_id, doc in zip(doc_ids, docs)}, vectors
+
+async def build_chunks(guideline, markdown_path, depth, manifest, **embed_kwargs):
+    directory = f'guideline_pkls/{guideline}'
+    with open(markdown_path, 'rb') as file:
+        source = file.read()
+    chunks = chunk_markdown(source.decode(), depth)
+
+    previous, vectors = await previous_build(directory, manifest)
+    previous_children = {content_hash(doc): children for doc, children in previous.values()}
+    raptor = {k: (doc, children) for k, (doc, children) in previous.items()
+              if 'Header 1' not in doc.metadata and content_hash(doc) not in chunks}
+
+    doc_ids, docs, summary_docs = [], [], []
+    carried = 0
+    for k, c in chunks.items():
+        doc_ids.append(k)
+        docs.append(Document(page_content=c.page_content, metadata=c.metadata))
+        children = previous_children.get(k)
+        if children:
+            carried += 1
+            summary_docs.extend(Document(page_content=s.page_content, metadata={**s.metadata, 'doc_id': k}) for s in children)
+        else:
+            summary_docs.append(Document(page_content=c.page_content, metadata={'doc_id': k}))
+    for k, (doc, children) in raptor.items():
+        doc_ids.append(k)
+        docs.append(doc)
+        summary_docs.extend(children)
+    dropped = len(previous) - carried - len(raptor)
+    if dropped:
+        print(f'{guideline}: {dropped} chunks of the previous build changed or were removed; their summaries were dropped')
+    if raptor:
+        print(f'{guideline}: carried over {len(raptor)} RAPTOR summaries unchanged; regenerate them if the sections they cover changed')
+
+    texts = {text_hash(d.page_content): d.page_content for d in summary_docs}
+    missing = [h for h in texts if h not in vectors]
+    vectors.update(zip(missing, await embed_texts([texts[h] for h in missing], **embed_kwargs)))
+
+    vectorstore = FAISS.from_embeddings(
+        [(d.page_content, vectors[text_hash(d.page_content)].tolist()) for d in summary_docs],
+        EMBD,
+        metadatas=[d.metadata for d in summary_docs]
+    )
+
+    os.makedirs(directory, exist_ok=True)
+    for name, obj in [('doc_ids', doc_ids), ('docs', docs), ('summary_docs', summary_docs)]:
+        with open(f'{directory}/{name}.pkl', 'wb') as file:
+            pickle.dump(obj, file)
+    vectorstore.save_local(f'{directory}/faiss')
+
+    manifest.update({
+        'embedding_model': EMBD.model,
+        'dims': int(vectorstore.index.d),
+        'source': {'path': markdown_path, 'sha256': hashlib.sha256(source).hexdigest()},
+        'chunks': doc_ids
+    })
+    print(f'{guideline}: {len(chunks)} chunks ({carried} kept their summaries), {len(summary_docs)} indexed, '
+          f'{len(missing)} embedded, {len(texts) - len(missing)} reused')
+
+async def build_split_embeddings(guideline, manifest, embed=True, **embed_kwargs):
+    directory = f'guideline_pkls/{guideline}'
+    splits = {s.id: s.page_content for doc_splits in build_splits(guideline).values() for s in doc_splits}
+    if not embed:
+        print(f'{guideline}: {len(splits)} splits')
+        return
+    embeddings = {}
+    if manifest.get('split_embeddings') and os.path.exists(f'{directory}/split_embeddings.pkl'):
+        with open(f'{directory}/split_embeddings.pkl', 'rb') as file:
+            embeddings = {k: v for k, v in pickle.load(file).items() if k in splits}
+    missing = [k for k in splits if k not in embeddings]
+    embeddings.update(zip(missing, await embed_texts([splits[k] for k in missing], **embed_kwargs)))
+    with open(f'{directory}/split_embeddings.pkl', 'wb') as file:
+        pickle.dump(embeddings, file)
+    manifest.update({'embedding_model': EMBD.model, 'split_embeddings': len(embeddings)})
+    print(f'{guideline}: {len(splits)} splits, {len(missing)} embedded, {len(splits) - len(missing)} reused')
+
+async def main(args):
+    markdown = dict(m.split('=', 1) for m in args.markdown)
+    embed_kwargs = {'batch_size': args.batch_size, 'concurrency': args.concurrency}
+    for guideline in args.guidelines or GUIDELINES:
+        directory = f'guideline_pkls/{guideline}'
+        manifest = load_manifest(directory)
+        if guideline in markdown:
+            await build_chunks(guideline, markdown[guideline], args.depth, manifest, **embed_kwargs)
+        await build_split_embeddings(guideline, manifest, embed=not args.no_embed, **embed_kwargs)
+        if not args.no_embed:
+            save_manifest(directory, manifest)
+        convert_pickles(guideline)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the guideline stores under guideline_pkls/')
+    parser.add_argument('guidelines', nargs='*', help=f'guidelines to build (default: {" ".join(GUIDELINES)})')
+    parser.add_argument('--markdown', action='append', default=[], metavar='GUIDELINE=PATH',
+                        help='cleaned guideline markdown to chunk and index; summaries of unchanged chunks are kept, '
+                             'and their vectors too if the existing index is from the same embedding model')
+    parser.add_argument('--depth', type=int, default=3, help='number of header levels to chunk on')
+    parser.add_argument('--no-embed', action='store_true', help='only rebuild the splits; no embedding calls')
+    parser.add_argument('--batch-size', type=int, default=EMBEDDING_BATCH_SIZE)
+    parser.add_argument('--concurrency', type=int, default=EMBEDDING_CONCURRENCY)
+    args = parser.parse_args()
+    if args.no_embed and args.markdown:
+        parser.error('--markdown needs embeddings; drop --no-embed')
+    asyncio.run(main(args))
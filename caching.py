@@ -0,0 +1,134 @@
+import os
+import json
+import base64
+import time
+import sqlite3
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """ Bounded in-memory LRU mapping; back it with a SQLiteCache to persist it """
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self._evict()
+
+    def items(self):
+        with self._lock:
+            return list(self._data.items())
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def _evict(self):
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+class SQLiteCache(object):
+    """ On-disk JSON key-value cache with a TTL and least-recently-used eviction past max_entries """
+    def __init__(self, path: str, max_entries: int, ttl: float = None, table: str = 'cache') -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # caches with different TTLs/limits can share a file, each in its own table
+        self.table = table
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)')
+        self._conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_accessed ON {table} (accessed)')
+
+    def get_many(self, keys: list[str]):
+        """ Values for each key, None where missing or expired """
+        if not keys:
+            return []
+        now = time.time()
+        oldest = now - self.ttl if self.ttl else 0
+        found = {}
+        with self._lock:
+            # stay under sqlite's bound-variable limit
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i+500]
+                marks = ','.join('?' * len(batch))
+                rows = self._conn.execute(f'SELECT key, value FROM {self.table} WHERE created >= ? AND key IN ({marks})', [oldest, *batch]).fetchall()
+                found.update(rows)
+                if rows:
+                    hit_marks = ','.join('?' * len(rows))
+                    self._conn.execute(f'UPDATE {self.table} SET accessed = ? WHERE key IN ({hit_marks})', [now, *[k for k, _ in rows]])
+        return [json.loads(found[k]) if k in found else None for k in keys]
+
+    def get(self, key: str):
+        return self.get_many([key])[0]
+
+    def set_many(self, items: dict):
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)',
+                                   [(k, json.dumps(v), now, now) for k, v in items.items()])
+            self._evict(now)
+
+    def set(self, key: str, value):
+        self.set_many({key: value})
+
+    def items(self):
+        """ Every unexpired (key, value) """
+        oldest = time.time() - self.ttl if self.ttl else 0
+        with self._lock:
+            rows = self._conn.execute(f'SELECT key, value FROM {self.table} WHERE created >= ?', (oldest,)).fetchall()
+        return [(k, json.loads(v)) for k, v in rows]
+
+    def delete_many(self, keys: list[str]):
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i+500]
+                self._conn.execute(f'DELETE FROM {self.table} WHERE key IN ({",".join("?" * len(batch))})', batch)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute(f'DELETE FROM {self.table}')
+
+    def _evict(self, now):
+        if self.ttl:
+            self._conn.execute(f'DELETE FROM {self.table} WHERE created < ?', (now - self.ttl,))
+        excess = self._conn.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0] - self.max_entries
+        if excess > 0:
+            self._conn.execute(f'DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} ORDER BY accessed LIMIT ?)', (excess,))
+
+
+# float32 vectors as JSON-safe strings, for SQLiteCache values
+def encode_vector(vector: np.ndarray):
+    return base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode()
+
+def decode_vector(stored: str):
+    return np.frombuffer(base64.b64decode(stored), dtype=np.float32)
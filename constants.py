@@ -1,12 +1,87 @@
-from langchain_openai import OpenAIEmbeddings
-from langchain_openai import ChatOpenAI
+from scheduler import Scheduler, ScheduledOpenAIEmbeddings, ScheduledChatOpenAI as ChatOpenAI
+from scheduler import CHAT, INTERACTIVE, BULK
+from llm_cache import LLMCache
 
-EMBD = OpenAIEmbeddings(model='text-embedding-3-large')
+BIG_MODEL = 'gpt-4o-2024-08-06'
+SMALL_MODEL = 'gpt-4o-mini-2024-07-18'
+EMBEDDING_MODEL = 'text-embedding-3-large'
+
+# every OpenAI request queues here for its model's budget (this process's share of the deployment's limits):
+# the chat stream and routing first, then the calls a request waits on (algo reader, query generation, embeddings),
+# then bulk work (doc filter, compressor, summaries). Rate-limited requests are retried with jittered backoff.
+MODEL_RATE_LIMITS = {  # models left out, or limits of None, are unlimited
+    BIG_MODEL: {'requests_per_minute': 5_000, 'tokens_per_minute': 800_000},
+    SMALL_MODEL: {'requests_per_minute': 5_000, 'tokens_per_minute': 4_000_000},
+    EMBEDDING_MODEL: {'requests_per_minute': 5_000, 'tokens_per_minute': 5_000_000},
+}
+SCHEDULER = Scheduler(MODEL_RATE_LIMITS, retries=6, backoff_seconds=1, backoff_max_seconds=60)
+
+EMBD = ScheduledOpenAIEmbeddings(model=EMBEDDING_MODEL, scheduler=SCHEDULER, priority=INTERACTIVE)
 
 RETRIEVAL_TOP_K = 5
 
-BIG_MODEL = 'gpt-4o-2024-08-06'
-SMALL_MODEL = 'gpt-4o-mini-2024-07-18'
+# each guideline has its own store under guideline_pkls/<name>
+GUIDELINES = ['cua', 'aua', 'eau']
+# search all guidelines through one combined index, rather than one index per guideline
+UNIFIED_GUIDELINE_INDEX = False
+
+# query embeddings are cached (LRU) across requests; set a path to also keep them in SQLite,
+# shared by every worker and across restarts
+QUERY_EMBEDDING_CACHE_SIZE = 4096
+QUERY_EMBEDDING_CACHE_PATH = None  # e.g. 'cache/query_embeddings.sqlite'
+QUERY_EMBEDDING_CACHE_MAX_ENTRIES = 100_000
+
+# start the guideline expansion/query generation alongside the router,
+# discarding it if the router decides the guidelines aren't needed
+SPECULATIVE_ROUTING = True
+
+# replay stored answers for near-identical questions in /chat
+RESPONSE_CACHE_ENABLED = False
+RESPONSE_CACHE_THRESHOLD = 0.95  # cosine similarity between prompts
+RESPONSE_CACHE_MAX_ENTRIES = 1000
+RESPONSE_CACHE_PATH = None
+
+# exact-match cache for the deterministic (temperature 0) chains, in memory and optionally on disk
+LLM_CACHE_PATH = 'cache/llm_calls.sqlite'  # None keeps it in memory only
+LLM_CACHE_MEMORY_SIZE = 1024  # entries per chain
+LLM_CACHE_MAX_ENTRIES = 50_000  # entries per chain, on disk
+LLM_CACHE_SETTINGS = {  # ttl in seconds, None never expires
+    'summary': {'enabled': False, 'ttl': None},
+    'filter': {'enabled': True, 'ttl': 30 * 24 * 60 * 60},
+    'router': {'enabled': True, 'ttl': 30 * 24 * 60 * 60},
+    'algo': {'enabled': True, 'ttl': 30 * 24 * 60 * 60},
+    'compressor': {'enabled': True, 'ttl': 30 * 24 * 60 * 60},
+    'multiquery': {'enabled': True, 'ttl': 30 * 24 * 60 * 60},
+    'rephrase': {'enabled': True, 'ttl': 30 * 24 * 60 * 60},
+    'reorg': {'enabled': True, 'ttl': 30 * 24 * 60 * 60},
+    'understanding': {'enabled': True, 'ttl': 30 * 24 * 60 * 60},
+}
+
+def llm_cache(name):
+    settings = LLM_CACHE_SETTINGS[name]
+    if not settings['enabled']:
+        return None
+    return LLMCache(name, ttl=settings['ttl'], memory_size=LLM_CACHE_MEMORY_SIZE, path=LLM_CACHE_PATH, max_entries=LLM_CACHE_MAX_ENTRIES)
+
+# conversation summaries kept for GET /summary/{conversation_id}
+SUMMARY_STORE_SIZE = 10_000
+# on shutdown, summaries still being written get this long to finish before they're cancelled
+SUMMARY_SHUTDOWN_SECONDS = 10
+
+# conversations are checkpointed per conversation_id (the summary, last retrieval and sources);
+# set the path to None to keep /chat stateless
+SESSION_CHECKPOINT_PATH = 'cache/sessions.sqlite'
+# a follow-up this similar (cosine, query embeddings) to the question that was last retrieved for
+# reuses those documents instead of running the guideline pipeline again
+SESSION_REUSE_RETRIEVAL = True
+SESSION_REUSE_THRESHOLD = 0.85
+
+# how often an idle /chat stream checks whether the client has gone
+DISCONNECT_POLL_SECONDS = 0.5
+
+# chat tokens are sent to the client in batches of up to this long / this many characters
+STREAM_COALESCE_SECONDS = 0.05
+STREAM_COALESCE_CHARS = 200
 
 # ------------------------------------------------------------------- #
 # we go in such painful granularity on the models,
@@ -14,22 +89,45 @@ SMALL_MODEL = 'gpt-4o-mini-2024-07-18'
 # Obviously doesn't matter right now
 
 # MAIN
-CONVLLM = ChatOpenAI(model=BIG_MODEL, temperature=0.5, streaming=True)
-SUMMLLM = ChatOpenAI(model=SMALL_MODEL, temperature=0, streaming=True)
+CONVLLM = ChatOpenAI(model=BIG_MODEL, temperature=0.5, streaming=True, stream_usage=True, scheduler=SCHEDULER, priority=CHAT)
+SUMMLLM = ChatOpenAI(model=SMALL_MODEL, temperature=0, streaming=True, stream_usage=True, scheduler=SCHEDULER, priority=BULK, cache=llm_cache('summary'))
 
 # Doc Filter
-FILTLLM = ChatOpenAI(model=SMALL_MODEL, temperature=0, streaming=True)
+FILTLLM = ChatOpenAI(model=SMALL_MODEL, temperature=0, streaming=True, stream_usage=True, scheduler=SCHEDULER, priority=BULK, cache=llm_cache('filter'))
+FILTER_BATCH_SIZE = 20  # splits judged per FILTLLM call; 1 = one call per split
+# local similarity prefilter, off until the split embeddings are built: run `python build_index.py`
+# (embeds every guideline's splits into its docstore.sqlite), then turn it on
+FILTER_PREFILTER_ENABLED = False
+# cosine similarity bands for the prefilter: at/above ACCEPT keep, below REJECT drop, in between ask FILTLLM
+FILTER_PREFILTER_ACCEPT = 0.65
+FILTER_PREFILTER_REJECT = 0.2
+# on-disk cache of filter verdicts per (query, split); set the path to None to disable
+FILTER_CACHE_PATH = 'cache/filter_verdicts.sqlite'
+FILTER_CACHE_MAX_ENTRIES = 200_000
+FILTER_CACHE_TTL = 30 * 24 * 60 * 60  # seconds
+
+# Context packing: token budget for the documents in the chat prompt,
+# and the shingle overlap at which a split counts as repeating one already packed
+CONTEXT_TOKEN_BUDGET = 6000
+CONTEXT_DEDUPE_OVERLAP = 0.6
 
 # Router
-ROUTERLLM = ChatOpenAI(model=SMALL_MODEL, temperature=0, streaming=True)
+ROUTERLLM = ChatOpenAI(model=SMALL_MODEL, temperature=0, streaming=True, stream_usage=True, scheduler=SCHEDULER, priority=CHAT, cache=llm_cache('router'))
+ROUTER_RULES_ENABLED = True  # route clear-cut BPH queries by term matching, ROUTERLLM only for the rest
 
 # Algo Reader
-ALGOLLM = ChatOpenAI(model=SMALL_MODEL, temperature=0, streaming=True)
+ALGOLLM = ChatOpenAI(model=SMALL_MODEL, temperature=0, streaming=True, stream_usage=True, scheduler=SCHEDULER, priority=INTERACTIVE, cache=llm_cache('algo'))
+ALGO_RULES_ENABLED = True  # read size/bleeding/anesthesia/sexual cues locally, ALGOLLM only when they're unclear
 
 # Contextual compressor
-COMPRESSORLLM = ChatOpenAI(model=SMALL_MODEL, temperature=0, streaming=True) 
+COMPRESSORLLM = ChatOpenAI(model=SMALL_MODEL, temperature=0, streaming=True, stream_usage=True, scheduler=SCHEDULER, priority=BULK, cache=llm_cache('compressor')) 
 
 # Multi query generator
-MULTIQUERYLLM = ChatOpenAI(model=BIG_MODEL, temperature=0, streaming=True)
-REPHRASINGLLM = ChatOpenAI(model=BIG_MODEL, temperature=0, streaming=True)
-REORGLLM = ChatOpenAI(model=SMALL_MODEL, temperature=0, streaming=True)
\ No newline at end of file
+MULTIQUERYLLM = ChatOpenAI(model=BIG_MODEL, temperature=0, streaming=True, stream_usage=True, scheduler=SCHEDULER, priority=INTERACTIVE, cache=llm_cache('multiquery'))
+REPHRASINGLLM = ChatOpenAI(model=BIG_MODEL, temperature=0, streaming=True, stream_usage=True, scheduler=SCHEDULER, priority=INTERACTIVE, cache=llm_cache('rephrase'))
+REORGLLM = ChatOpenAI(model=SMALL_MODEL, temperature=0, streaming=True, stream_usage=True, scheduler=SCHEDULER, priority=INTERACTIVE, cache=llm_cache('reorg'))
+
+# Fused query understanding: routing, algorithm features and all the queries in one call,
+# instead of the router / algo reader / multi-query / rephrase / reorg calls
+FUSED_QUERY_UNDERSTANDING = False
+QUERYLLM = ChatOpenAI(model=BIG_MODEL, temperature=0, streaming=True, stream_usage=True, scheduler=SCHEDULER, priority=CHAT, cache=llm_cache('understanding'))
\ No newline at end of file
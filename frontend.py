@@ -4,12 +4,16 @@ import re
 import requests
 import json
 import os
+import uuid
+from st_utils import StState
 from dotenv import load_dotenv
 load_dotenv()
 
 backend_url = os.getenv('BACKEND_URL')
 
 st.set_page_config(layout="wide")
+# the backend keeps the conversation (summary, last retrieval) under this id
+conversation_id = StState('conversation_id', uuid.uuid4().hex)
 
 def replace_doc_placeholders(input_string, readable_sources):
     link_trans_table = str.maketrans({
@@ -48,39 +52,40 @@ async def rungraph(inputs):
     
     with requests.post(backend_url, json=inputs, stream=True) as resp:
         for line in resp.iter_lines():
-            line = json.loads(line)
-            if 'node' in line:
-                if curr_node == 'chat' and line['node'] != 'chat':
-                    chat_response = chat_response.replace(', []', '').replace('. []', '').replace('[]', '')
-                    container.markdown(chat_response)
-                curr_node = line['node']
-            elif 'content' in line:
-                content = line['content']
+            event = json.loads(line)
+            if event['event'] == 'node_start':
+                curr_node = event['node']
+            elif event['event'] == 'done':
+                # the answer is complete; the graph ends with the chat node
+                chat_response = chat_response.replace(', []', '').replace('. []', '').replace('[]', '')
+                container.markdown(chat_response)
+            elif event['event'] == 'token':
+                content = event['content']
 
-            if curr_node == 'expander':
+            if curr_node in ['session', 'router']:
+                status_container.progress(5, text='Understanding Query...')
+            elif curr_node == 'expander':
                 status_container.progress(15, text='Generating Topic Expansion...')
             elif curr_node == 'multiquery':
                 status_container.progress(30, text='Generating Topic Expansion...')
             elif curr_node == 'retrieval':
                 status_container.progress(57, text='Retrieving Knowledge...')
-            elif curr_node in ['filter', 'prompt_synthesis']:
+            elif curr_node in ['filter', 'references', 'prompt_synthesis']:
                 status_container.progress(80, text='Compressing and Synthesizing Query...')
             elif curr_node == 'chat':
                 status_container.empty()
 
-            if curr_node == 'chat' and content:
+            if content:
                 chat_response += content
                 chat_response = replace_doc_placeholders(chat_response, readable_sources)
                 chat_response = chat_response.replace('[],', '').replace('[].', '')
                 container.markdown(chat_response)
                 content = ''
-            elif curr_node == 'summarizer' and content:
-                final_sources = content
-                content = ''
-            elif curr_node == 'filter' and content:
-                readable_sources = content
+            elif event['event'] == 'sources':
+                final_sources = event['sources']
+            elif event['event'] == 'documents':
+                readable_sources = event['documents']
                 readable_sources_str = '\n\n---\n\n'.join([f'{s['page_content']}\n\nSource: {s['metadata']}' for s in readable_sources if len(s['metadata']) > 1])
-                content = ''
         
             if final_sources != 'n/a':
                 with sources_container.expander('Sources'):
@@ -96,7 +101,7 @@ input_text = st.text_input(label='Ask anything about BPH')
 if input_text:
     try:
         with st.spinner('Generating...'):
-            asyncio.run(rungraph(inputs={'prompt': input_text}))    
+            asyncio.run(rungraph(inputs={'prompt': input_text, 'conversation_id': st.session_state[conversation_id.name]}))    
     except Exception as e:
         st.error(f"Error: {e}")
 
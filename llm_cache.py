@@ -0,0 +1,56 @@
+import time
+import hashlib
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+
+from caching import LRUCache, SQLiteCache
+
+
+class LLMCache(BaseCache):
+    """ Exact-match cache of chat model generations: an in-memory LRU, optionally backed by SQLite
+
+    LangChain keys lookups on the serialized prompt messages and the model's llm_string,
+    which covers the model name, its parameters and any bound structured-output schema.
+    """
+    def __init__(self, name: str, ttl: float = None, memory_size: int = 1024, path: str = None, max_entries: int = 50_000) -> None:
+        self.name = name
+        self.ttl = ttl
+        self.memory = LRUCache(memory_size)
+        self.disk = SQLiteCache(path, max_entries, ttl=ttl, table=f'llm_{name}') if path else None
+
+    def _key(self, prompt: str, llm_string: str):
+        return hashlib.sha256(f'{llm_string}\n{prompt}'.encode()).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str):
+        key = self._key(prompt, llm_string)
+        hit = self.memory.get(key)
+        if hit is not None:
+            created, generations = hit
+            if not self.ttl or time.time() - created < self.ttl:
+                return _replayed(generations)
+            self.memory.pop(key)
+        if self.disk is not None:
+            stored = self.disk.get(key)
+            if stored is not None:
+                generations = [loads(g) for g in stored['generations']]
+                self.memory.set(key, (stored['created'], generations))
+                return _replayed(generations)
+        return None
+
+    def update(self, prompt: str, llm_string: str, return_val):
+        key = self._key(prompt, llm_string)
+        created = time.time()
+        self.memory.set(key, (created, return_val))
+        if self.disk is not None:
+            self.disk.set(key, {'created': created, 'generations': [dumps(g) for g in return_val]})
+
+    def clear(self, **kwargs):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+
+def _replayed(generations):
+    # copies marked as served from this cache, so token accounting (metrics.TokenUsage) can tell them from real calls
+    return [g.copy(update={'message': g.message.copy(update={'response_metadata': {**g.message.response_metadata, 'llm_cache_hit': True}})})
+            if hasattr(g, 'message') else g for g in generations]
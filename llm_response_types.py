@@ -4,6 +4,9 @@ from typing import List
 class BooleanResponse(TypedDict):
     b: bool
 
+class ListOfBooleansResponse(TypedDict):
+    l: List[bool]
+
 class StringResponse(TypedDict):
     s: str
 
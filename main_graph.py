@@ -8,31 +8,43 @@ os.environ['LANGCHAIN_API_KEY'] = os.getenv('LS_APIKEY')
 os.environ['LANGCHAIN_ENDPOINT'] = 'https://api.smith.langchain.com'
 os.environ['LANGCHAIN_PROJECT'] = os.getenv('LS_PROJECT_NAME')
 
+import asyncio
+import logging
+import numpy as np
 from typing import Annotated
 from typing_extensions import TypedDict
 from langgraph.graph import StateGraph, START, END
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 
-from nodes.routingagent import router_chain
+from nodes.routingagent import router_chain, rule_route
 from nodes.algoreader import tx_algo_chain
 from nodes.multiretriever import generate_queries, reciprocal_rank_fusion
-from nodes.retriever import guideline_retrievers
-from nodes.llm_doc_filter import doc_filter_chain
+from nodes.retriever import asearch_guidelines
+from nodes.query_embeddings import aembed_queries
+from nodes.llm_doc_filter import docs_filter_chain
+from nodes.context_packer import pack_context
+from nodes.query_understanding import query_understanding_chain
 
-from template import surg_abbrevs_table
-from template import template, summary_template, memory_template
+from template import template, context_template, guideline_template, summary_template, memory_template
 
-from constants import CONVLLM, SUMMLLM
+from metrics import metrics
+from constants import CONVLLM, SUMMLLM, SPECULATIVE_ROUTING, ROUTER_RULES_ENABLED, FUSED_QUERY_UNDERSTANDING
+from constants import SESSION_REUSE_RETRIEVAL, SESSION_REUSE_THRESHOLD
 
 # --- constants ---
 #EDUCATION_LEVEL = 'Your answer should be highly sophisticated, at the level of a post doctoral researcher in the field.'
 EDUCATION_LEVEL = 'Your answer should be quite succinct and patient oriented, at a grade 12 reading level.'
 
+logger = logging.getLogger(__name__)
+
 # --- reducer functions ---
 def overwrite(_, new):
     return new
 
+def merge(old, new):
+    return {**(old or {}), **new}
+
 # --- basic graph elements ---
 class State(TypedDict):
     prompt: str
@@ -42,74 +54,156 @@ class State(TypedDict):
     algo_recs: dict
     multiqueries: Annotated[dict, overwrite]
     raw_retrieved: dict
+    retrieval_scores: dict
     filtered_retrieved: dict
     final_synthesized_prompt: ChatPromptTemplate
     response: str
     sources: str
+    stats: Annotated[dict, merge]
+    # kept across turns by the checkpointer
+    retrieval_topic: str
+    source_ids: list
+    reuse_retrieval: bool
 graph_builder = StateGraph(State)
 
 # --- define nodes and edges ---
-def router_node(state: State):
-    _input = {'question': state['prompt'], 'summary': state['summary']}
-    use_guidelines = router_chain.invoke(_input)
-    return {'use_guidelines': use_guidelines['b']}
+async def session_node(state: State):
+    # with a checkpointer, the previous turn's state is still here;
+    # a follow-up on the same topic answers from the documents already retrieved and filtered
+    summary = state.get('summary') or ''
+    # the previous question's treatment recommendations never carry over to this one
+    fresh = {'summary': summary, 'guiding_prompt': '', 'algo_recs': {}, 'reuse_retrieval': False}
+    topic = state.get('retrieval_topic')
+    if not (SESSION_REUSE_RETRIEVAL and topic and state.get('use_guidelines') and state.get('filtered_retrieved')):
+        return fresh
+    current, previous = await aembed_queries([state['prompt'], topic])
+    similarity = float(current @ previous / (np.linalg.norm(current) * np.linalg.norm(previous)))
+    reuse = similarity >= SESSION_REUSE_THRESHOLD
+    stats = {'session': {'similarity': round(similarity, 3), 'reused': reuse}}
+    if not reuse:
+        return {**fresh, 'stats': stats}
+    metrics.incr('session.reused')
+    # the router and expander are skipped, so read this prompt's size and risk cues here
+    expansion = await expansion_node({**state, 'summary': summary})
+    return {
+        **fresh,
+        **expansion,
+        'reuse_retrieval': True,
+        'use_guidelines': True,
+        'filtered_retrieved': state['filtered_retrieved'],
+        'multiqueries': {'reorganized': state['prompt']},
+        'stats': stats
+    }
+def session_edge(state: State):
+    if state['reuse_retrieval']:
+        return '__reuse__'
+    else:
+        return '__new__'
+
+async def router_node(state: State):
+    terms = rule_route(state['prompt'], state['summary']) if ROUTER_RULES_ENABLED else []
+    if terms:
+        path, use_guidelines = 'rules', True
+    else:
+        _input = {'question': state['prompt'], 'summary': state['summary']}
+        path, use_guidelines = 'llm', (await router_chain.ainvoke(_input))['b']
+    metrics.incr(f'router.{path}')
+    return {'use_guidelines': use_guidelines, 'stats': {'router': {'path': path, 'terms': sorted(set(terms))}}}
 def router_edge(state: State):
     if state['use_guidelines']:
         return '__use_guidelines__'
     else:
         return '__no__'
 
-def expansion_node(state: State):
-    _input = {'question': state['prompt'], 'summary': state['summary']}
-    _raw = tx_algo_chain.invoke(_input)
+def guiding_prompt_from_recs(_raw: dict):
+    # only the per-request recommendations; the standing guidance is the static guideline_template
     _algo_recs = [v for k, v in _raw.items() if (v and k != 'metadata')]
-    _algo_recs_str = ''
-    if _algo_recs:
-        _algo_recs = '\n\n'.join(_algo_recs)
-        _algo_recs_str = 'For the next user query, the recommendations are as follows:\n\n'+\
-                        f'{_algo_recs}\n\n'+\
-                        'Since different guidelines use different terms to refer to the same treatment, '+\
-                        f'always unify them using this reference table:\n\n{surg_abbrevs_table}\n\n'
-    guiding_prompt = f'{_algo_recs_str}You should try to combine the information from each guideline where possible, '+\
-                     'highlighting only major differences as you go, if applicable.\n'+\
-                     'You should give a brief comparison between the guidelines (CUA, AUA, EAU), at the end of your response.'
-    algo_recs_options = _raw['metadata']
-    return {'guiding_prompt': guiding_prompt, 'algo_recs': algo_recs_options}
-
-def multiquery_node(state: State):
+    if not _algo_recs:
+        return ''
+    _algo_recs = '\n\n'.join(_algo_recs)
+    return f'For the next user query, the recommendations are as follows:\n\n{_algo_recs}'
+
+async def expansion_node(state: State):
+    _input = {'question': state['prompt'], 'summary': state['summary']}
+    _raw = await tx_algo_chain.ainvoke(_input)
+    return {'guiding_prompt': guiding_prompt_from_recs(_raw), 'algo_recs': _raw['metadata']}
+
+async def multiquery_node(state: State):
     _input = {'question': state['prompt'], 'summary': state['summary'], 'tx_options': state['algo_recs']}
-    queries_dict = generate_queries.invoke(_input)
+    queries_dict = await generate_queries.ainvoke(_input)
     return {'multiqueries': queries_dict}
 
-def retrieval_node(state: State):
+async def guideline_path(state: State):
+    expansion = await expansion_node(state)
+    queries = await multiquery_node({**state, **expansion})
+    return {**expansion, **queries}
+
+async def speculative_router_node(state: State):
+    # most queries are about BPH, so don't wait on the router before expanding;
+    # the guideline path is cancelled mid-flight if the router says no
+    guideline_task = asyncio.create_task(guideline_path(state))
+    try:
+        routed = await router_node(state)
+        if routed['use_guidelines']:
+            return {**routed, **(await guideline_task)}
+        return routed
+    finally:
+        guideline_task.cancel()
+
+async def query_understanding_node(state: State):
+    _input = {'question': state['prompt'], 'summary': state['summary']}
+    understood = await query_understanding_chain.ainvoke(_input)
+    metrics.incr('router.fused')
+    stats = {'router': {'path': 'fused'}}
+    if not understood['use_guidelines']:
+        return {'use_guidelines': False, 'stats': stats}
+    return {
+        'use_guidelines': True,
+        'guiding_prompt': guiding_prompt_from_recs(understood['algo']),
+        'algo_recs': understood['algo']['metadata'],
+        'multiqueries': understood['queries'],
+        'stats': stats
+    }
+
+async def retrieval_node(state: State):
     _queries_list = [q for q in state['multiqueries'].values() if q]
-    retrieved = []
-    for retriever in guideline_retrievers.values():
-        ret_chain = retriever.map() | reciprocal_rank_fusion
-        retrieved.append(ret_chain.invoke(_queries_list))
-    raw_retrieved = reciprocal_rank_fusion(retrieved)
-    return {'raw_retrieved': raw_retrieved}
-
-def filter_node(state: State):
-    _inputs = [{'document': doc, 'queries_dict': state['multiqueries']} for doc in state['raw_retrieved']]
-    filter = doc_filter_chain.map().invoke(_inputs)
-    filtered_retrieved = [doc for doc in filter if doc.page_content]
-    return {'filtered_retrieved': filtered_retrieved}
-
-def prompt_synthesis_node(state: State):
+    # embed once, then search every guideline concurrently with the same vectors
+    _vectors = await aembed_queries(_queries_list)
+    retrieved = await asearch_guidelines(_vectors)
+    retrieved = [[d for d, _ in reciprocal_rank_fusion(r)] for r in retrieved.values()]
+    fused = reciprocal_rank_fusion(retrieved)
+    raw_retrieved = [d for d, _ in fused]
+    retrieval_scores = {d.id: score for d, score in fused}
+    return {'raw_retrieved': raw_retrieved, 'retrieval_scores': retrieval_scores, 'retrieval_topic': state['prompt']}
+
+async def filter_node(state: State):
+    _input = {'documents': state['raw_retrieved'], 'queries_dict': state['multiqueries']}
+    filter = await docs_filter_chain.ainvoke(_input)
+    logger.info('filter splits: %s', filter['stats'])
+    # packed here, so the documents streamed from this node are the ones chat_node numbers
+    packed, packing = await asyncio.to_thread(pack_context, filter['documents'], filter['splits'], state['retrieval_scores'])
+    filtered_retrieved = [doc for doc in packed if doc.page_content]
+    return {'filtered_retrieved': filtered_retrieved, 'source_ids': [d.id for d in filtered_retrieved], 'stats': {'filter': filter['stats'], 'packing': packing}}
+
+async def prompt_synthesis_node(state: State):
+    # static instructions first and per-request content last, so consecutive requests share a cacheable prefix
     if not state['use_guidelines']:
         synthesized = [
                 ('system', template),
+                ('system', context_template),
                 ('ai', memory_template),
                 ('human', state['prompt'])
             ]
     else:
         synthesized = [
                 ('system', template),
+                ('system', guideline_template),
+                ('system', context_template),
                 ('ai', memory_template),
-                ('system', state['guiding_prompt']),
-                ('human', state['prompt'])
             ]
+        if state['guiding_prompt']:
+            synthesized.append(('system', state['guiding_prompt']))
+        synthesized.append(('human', state['prompt']))
         if state['multiqueries'].get('reorganized'):
             synthesized.extend([
                 ('ai', f'Based on the query and context, I think the user is asking: {state['multiqueries']["reorganized"]}'),
@@ -121,27 +215,19 @@ def prompt_synthesis_node(state: State):
     synthesized = ChatPromptTemplate.from_messages(synthesized)
     return {'final_synthesized_prompt': synthesized}
     
-def chat_node(state: State):
+async def chat_node(state: State):
     if not state['use_guidelines']:
         sources = '```None```'
     else:
         sources = [f'```<document_#{i+1}>\nSOURCE: {d.metadata.get('Title', d.metadata)}\n\n{d.page_content}\n</document_#{i+1}>```' for i, d in enumerate(state['filtered_retrieved'])]
         sources = '\n\n'.join(sources)
     chain = state['final_synthesized_prompt'] | CONVLLM | StrOutputParser()
-    response = chain.invoke({'context': sources, 'summary': state['summary']})
+    response = await chain.ainvoke({'context': sources, 'summary': state['summary']})
     return {'response': response}
 
-def summary_node(state: State):
+async def sources_node(state: State):
     if not state['use_guidelines']:
-        return {'summary': state['summary'], 'sources': 'n/a'}
-    messages = [
-        ('ai', memory_template),
-        ('human', state['prompt']),
-        ('ai', state['response']),
-        ('system', summary_template)
-    ]
-    chain = ChatPromptTemplate.from_messages(messages) | SUMMLLM | StrOutputParser()
-    summary = chain.invoke({'summary': state['summary']})
+        return {'sources': 'n/a'}
     if state['filtered_retrieved']:
         sources = [d.metadata for d in state['filtered_retrieved'] if d.metadata.get('Header 1')]
         final_sources = []
@@ -166,32 +252,62 @@ def summary_node(state: State):
         final_sources_str = f'{"\n".join(final_sources)}\n\nRAPTOR Documents: {raptor_num_str if raptor_num_str else "n/a"}'
     else:
         final_sources_str = 'n/a'
-    return {'summary': summary, 'sources': final_sources_str}
+    return {'sources': final_sources_str}
+
+# --- conversation summary ---
+# not a graph node: it's only needed for the next turn, so it's generated after the answer has streamed
+async def summarize(prompt: str, response: str, summary: str, use_guidelines: bool):
+    if not use_guidelines:
+        return summary
+    messages = [
+        ('ai', memory_template),
+        ('human', prompt),
+        ('ai', response),
+        ('system', summary_template)
+    ]
+    chain = ChatPromptTemplate.from_messages(messages) | SUMMLLM | StrOutputParser()
+    return await chain.ainvoke({'summary': summary})
 
 # --- add nodes ---
-graph_builder.add_node('router', router_node)
-graph_builder.add_node('expander', expansion_node)
-graph_builder.add_node('multiquery', multiquery_node)
+graph_builder.add_node('session', session_node)
+# the router node also produces the queries when fused or speculative, and goes straight to retrieval
+ROUTER_EXPANDS = FUSED_QUERY_UNDERSTANDING or SPECULATIVE_ROUTING
+if FUSED_QUERY_UNDERSTANDING:
+    graph_builder.add_node('router', query_understanding_node)
+elif SPECULATIVE_ROUTING:
+    graph_builder.add_node('router', speculative_router_node)
+else:
+    graph_builder.add_node('router', router_node)
+    graph_builder.add_node('expander', expansion_node)
+    graph_builder.add_node('multiquery', multiquery_node)
 graph_builder.add_node('retrieval', retrieval_node)
 graph_builder.add_node('filter', filter_node)
+graph_builder.add_node('references', sources_node)
 graph_builder.add_node('prompt_synthesis', prompt_synthesis_node)
 graph_builder.add_node('chat', chat_node)
-graph_builder.add_node('summarizer', summary_node)
 
 # --- add edges ---
-graph_builder.add_edge(START, 'router')
+graph_builder.add_edge(START, 'session')
+graph_builder.add_conditional_edges(
+    source='session',
+    path=session_edge,
+    path_map={'__reuse__': 'references', '__new__': 'router'}
+)
 graph_builder.add_conditional_edges(
     source='router',
     path=router_edge,
-    path_map={'__use_guidelines__': 'expander', '__no__': 'prompt_synthesis'}
+    path_map={'__use_guidelines__': 'retrieval' if ROUTER_EXPANDS else 'expander', '__no__': 'references'}
 )
-graph_builder.add_edge('expander', 'multiquery')
-graph_builder.add_edge('multiquery', 'retrieval')
+if not ROUTER_EXPANDS:
+    graph_builder.add_edge('expander', 'multiquery')
+    graph_builder.add_edge('multiquery', 'retrieval')
 graph_builder.add_edge('retrieval', 'filter')
-graph_builder.add_edge('filter', 'prompt_synthesis')
+# sources are sent to the client before the answer starts
+graph_builder.add_edge('filter', 'references')
+graph_builder.add_edge('references', 'prompt_synthesis')
 graph_builder.add_edge('prompt_synthesis', 'chat')
-graph_builder.add_edge('chat', 'summarizer')
-graph_builder.add_edge('summarizer', END)
+graph_builder.add_edge('chat', END)
 
 # --- compile graph ---
+# stateless; api.py compiles its own with a checkpointer, so conversations persist between requests
 graph = graph_builder.compile()
\ No newline at end of file
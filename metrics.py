@@ -0,0 +1,71 @@
+import threading
+from collections import Counter
+from langchain_core.callbacks import BaseCallbackHandler
+
+
+class Metrics(object):
+    """ Process-wide counters, served on /metrics """
+    def __init__(self) -> None:
+        self._counters = Counter()
+        self._lock = threading.Lock()
+
+    def incr(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] += value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
+
+
+class TokenUsage(BaseCallbackHandler):
+    """ Tokens used by the LLM calls of one request, counted as each call finishes """
+    run_inline = True
+
+    def __init__(self) -> None:
+        self.input_tokens = 0
+        self.cached_input_tokens = 0  # of input_tokens, those the provider served from its prompt cache
+        self.output_tokens = 0
+        self.calls = []
+        self._runs = {}
+
+    @property
+    def total(self):
+        return self.input_tokens + self.output_tokens
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs) -> None:
+        metadata = metadata or {}
+        self._runs[run_id] = {'node': metadata.get('langgraph_node'), 'model': metadata.get('ls_model_name')}
+
+    def on_llm_end(self, response, *, run_id=None, **kwargs) -> None:
+        call = {'node': None, 'model': None, **self._runs.pop(run_id, {}), 'input': 0, 'input_cached': 0, 'output': 0}
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, 'message', None)
+                usage = getattr(message, 'usage_metadata', None)
+                if message is not None and message.response_metadata.get('llm_cache_hit'):
+                    # replayed from LLMCache: the stored usage was spent by the original call, not this one
+                    call['llm_cache_hit'] = True
+                elif usage:
+                    call['input'] += usage.get('input_tokens', 0)
+                    call['input_cached'] += message.response_metadata.get('cached_tokens', 0)
+                    call['output'] += usage.get('output_tokens', 0)
+        self.input_tokens += call['input']
+        self.cached_input_tokens += call['input_cached']
+        self.output_tokens += call['output']
+        self.calls.append(call)
+        metrics.incr('tokens.input', call['input'])
+        metrics.incr('tokens.input_cached', call['input_cached'])
+
+    def report(self) -> dict:
+        """ Input tokens, cached vs uncached, in total and per LLM call """
+        return {
+            'input': self.input_tokens,
+            'input_cached': self.cached_input_tokens,
+            'input_uncached': self.input_tokens - self.cached_input_tokens,
+            'output': self.output_tokens,
+            'calls': self.calls,
+        }
+
+
+metrics = Metrics()
@@ -1,9 +1,11 @@
+import re
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import chain
 
 from typing_extensions import TypedDict, Annotated, Literal, Union
 
-from constants import ALGOLLM
+from metrics import metrics
+from constants import ALGOLLM, ALGO_RULES_ENABLED
 
 
 algorithms = {
@@ -39,10 +41,13 @@ algorithms = {
 
 
 sys_template = \
+"""Given the user query and conversation context, extract information into a structured format as provided."""
+
+hum_template = \
 """Last updated conversation context:
 {summary}
 
-Given the user query and conversation context, extract information into a structured format as provided."""
+Query: {question}"""
 
 
 class AlgorithmRecommendations(TypedDict):
@@ -56,7 +61,7 @@ class AlgorithmRecommendations(TypedDict):
 prompt = ChatPromptTemplate.from_messages(
     [
         ('system', sys_template),
-        ('human', "Query: {question}")
+        ('human', hum_template)
     ]
 )
 
@@ -64,23 +69,136 @@ def get_recs_sentence(header: str, input: dict):
     lines = [f'{algo.upper()} Guidelines recommend: {recs}' for algo, recs in input.items()]
     return f'{header} {', '.join(lines)}.' if lines else None
 
-@chain
-def tx_algo_chain(_input):
-    question, summary = _input['question'], _input['summary']
-    _chain = prompt | ALGOLLM.with_structured_output(schema=AlgorithmRecommendations, method='json_schema', strict=True)
-    _llmresp = _chain.invoke({'question': question, 'summary': summary})
+# --- local extraction ---
+# Most queries state their cues plainly ("65cc", "on Eliquis", "worried about erections"), so they are read
+# off the query and summary here. Negated, conflicting or vague cues are left to ALGOLLM.
+VOLUME = r'(\d+(?:\.\d+)?)\s*(?:cc|ml|g|grams?|cm3|cm\^3|cubic centimet(?:er|re)s?)\b(?!\s*/\s*(?:s|sec|min|h|hr|day)\b)'
+volume_pattern = re.compile(r'(<|>|less than|under|below|greater than|more than|over|above)?\s*' + VOLUME, re.I)
+volume_range_pattern = re.compile(r'(\d+(?:\.\d+)?)\s*(?:-|–|to)\s*' + VOLUME, re.I)
+# size talk without a volume we can read
+vague_size_pattern = re.compile(r'\b(?:small|large|big|huge|massive|giant|enormous|tiny|very enlarged)\s+(?:\w+\s+)?prostate|'
+                                r'\b(?:size|volume|weigh\w*|measur\w*)\b\D{0,20}\d', re.I)
+# a volume only counts as the prostate's next to a prostate or size cue; bladder, urine and fluid volumes are skipped
+prostate_cue_pattern = re.compile(r'\b(?:prostat\w*|gland|trus|transrectal)\b', re.I)
+size_cue_pattern = re.compile(r'\b(?:size[ds]?|volume|weigh\w*|measur\w*|enlarged|ultrasound)\b', re.I)
+other_volume_pattern = re.compile(r'\b(?:pvr|post[- ]?void\w*|void\w*|residual|retain\w*|urine|urinat\w*|pee\w*|bladder|capacity|'
+                                  r'intake|drink\w*|water|fluids?|qmax|flow|catheter\w*|per day|a day|daily)\b', re.I)
+
+def cue_pattern(terms: list[str]):
+    return re.compile(r'\b(?:' + '|'.join(terms) + r')', re.I)
+
+cue_patterns = {
+    'q_b': cue_pattern([
+        'anticoagula', 'antiplatelet', 'anti-platelet', 'blood thinn', 'doac', 'noac', 'warfarin', 'coumadin', 'apixaban',
+        'eliquis', 'rivaroxaban', 'xarelto', 'dabigatran', 'pradaxa', 'edoxaban', 'heparin', 'enoxaparin', 'lovenox',
+        'dalteparin', 'lmwh', 'clopidogrel', 'plavix', 'ticagrelor', 'brilinta', 'prasugrel', 'aspirin', 'bleeding disorder',
+        'bleeding risk', 'coagulopathy', 'hemophilia', 'haemophilia', 'von willebrand', 'thrombocytopenia',
+    ]),
+    'q_m': cue_pattern([
+        'unfit', 'frail', 'poor (?:surgical )?candidate', 'high[- ]risk (?:for |of )?(?:surgery|anaesthe|anesthe)',
+        "(?:can't|cannot|can not|unable to) (?:have|tolerate|undergo) (?:general |spinal )?(?:anaesthe|anesthe|surgery)",
+        'medically (?:complicated|complex)', 'comorbid', 'heart failure', 'copd', 'severe (?:heart|lung|cardiac)',
+    ]),
+    'q_s': cue_pattern([
+        'erectile', 'erection', 'ejaculat', 'sexual', 'libido', 'orgasm', 'impoten', 'sex life', '(?-i:ED|EjD)\\b',
+    ]),
+}
+# mentions that could go either way for the flag they'd set
+ambiguous_patterns = {
+    'q_m': cue_pattern(['anaesthe', 'anesthe', 'elderly', 'fitness for surgery']),
+}
+negation_pattern = re.compile(r"\b(?:not|no|non|never|without|free of|stopped|off|quit|denies|don't|doesn't|isn't|aren't|wasn't|nor|neither)\b[^.;,]{0,30}$", re.I)
+# negated by what follows the term: "aspirin-free", "anticoagulant free", "anticoagulation-naive"
+negated_suffix_pattern = re.compile(r"^\w*(?:-|\s)?(?:free|naive|naïve)\b", re.I)
+
+def size_bucket(volume: float):
+    return '<30cc' if volume < 30 else '30-80cc' if volume <= 80 else '>80cc'
+
+def volume_context(text: str, start: int, end: int):
+    # the words around a volume, within its clause
+    before = re.split(r'[.;,!?\n]', text[max(0, start - 40):start])[-1]
+    after = re.split(r'[.;,!?\n]', text[end:end + 25])[0]
+    return f'{before} {after}'
+
+def volume_kind(text: str, match: re.Match):
+    """ 'prostate', 'other' (PVR, bladder, fluid intake, ...), or None if it can't be told """
+    context = volume_context(text, match.start(), match.end())
+    prostate = prostate_cue_pattern.search(context)
+    if other_volume_pattern.search(context):
+        return None if prostate else 'other'
+    return 'prostate' if prostate or size_cue_pattern.search(context) else None
+
+def extract_size(text: str):
+    """ Size buckets stated in the text, and whether there was size talk that couldn't be read """
+    buckets = set()
+    for m in volume_range_pattern.finditer(text):
+        kind = volume_kind(text, m)
+        if kind is None:
+            return buckets, True
+        if kind == 'prostate':
+            buckets |= {size_bucket(float(m[1])), size_bucket(float(m[2]))}
+    text = volume_range_pattern.sub(' ', text)
+    for m in volume_pattern.finditer(text):
+        kind = volume_kind(text, m)
+        if kind is None:
+            return buckets, True
+        if kind == 'other':
+            continue
+        volume, comparator = float(m[2]), (m[1] or '').lower()
+        if comparator in ('<', 'less than', 'under', 'below') and volume <= 30:
+            buckets.add('<30cc')
+        elif comparator in ('>', 'greater than', 'more than', 'over', 'above') and volume >= 80:
+            buckets.add('>80cc')
+        elif comparator and volume in (30, 80):
+            buckets.add('30-80cc')
+        elif comparator:
+            return buckets, True
+        else:
+            buckets.add(size_bucket(volume))
+    vague = not buckets and bool(vague_size_pattern.search(text))
+    return buckets, vague
+
+def extract_features(question: str, summary: str = ''):
+    """ AlgorithmRecommendations read off the query and summary, or None if it needs ALGOLLM """
+    # the query is the latest word on size; the summary only fills in when the query has none
+    buckets, vague = extract_size(question)
+    if not buckets and not vague:
+        buckets, vague = extract_size(summary or '')
+    if vague or len(buckets) > 1:
+        return None
+    features = {'size': buckets.pop() if buckets else 'None'}
+    text = f'{summary or ""}\n{question}'
+    for flag, pattern in cue_patterns.items():
+        matches = list(pattern.finditer(text))
+        if any(negation_pattern.search(text[:m.start()]) or negated_suffix_pattern.match(text[m.end():]) for m in matches):
+            return None
+        if not matches and flag in ambiguous_patterns and ambiguous_patterns[flag].search(text):
+            return None
+        features[flag] = bool(matches)
+    return features
+
+def algo_recommendations(features: AlgorithmRecommendations):
     ans = {
-        'size': algorithms.get(_llmresp['size'], {}),
-        'q_s': algorithms['q_s'] if _llmresp['q_s'] else {},
-        'q_m': algorithms['q_m'] if _llmresp['q_m'] else {},
-        'q_b': algorithms['q_b'] if _llmresp['q_b'] else {}
+        'size': algorithms.get(features['size'], {}),
+        'q_s': algorithms['q_s'] if features['q_s'] else {},
+        'q_m': algorithms['q_m'] if features['q_m'] else {},
+        'q_b': algorithms['q_b'] if features['q_b'] else {}
     }
     ret = {
-        'size': get_recs_sentence(header=f'Based solely on the patient\'s prostate size of {_llmresp['size']}:', input=ans['size']),
+        'size': get_recs_sentence(header=f'Based solely on the patient\'s prostate size of {features['size']}:', input=ans['size']),
         'q_s': get_recs_sentence(header='Based solely on the patient\'s interest in preservation of sexual function (including erectile & ejaculatory function):', input=ans['q_s']),
         'q_m': get_recs_sentence(header='Based solely on the patient\'s medical complexity (i.e. unfit or cannot have anesthesia):', input=ans['q_m']),
         'q_b': get_recs_sentence(header='Based solely on the patient\'s risk for bleeding / hematuria (e.g. patients on anticoagulation or antiplatelet therapy):', input=ans['q_b']),
         'metadata': {k:v for k, v in ans.items() if v}
     }
+    return ret
 
-    return ret
\ No newline at end of file
+@chain
+async def tx_algo_chain(_input):
+    question, summary = _input['question'], _input['summary']
+    features = extract_features(question, summary) if ALGO_RULES_ENABLED else None
+    metrics.incr('algo.rules' if features is not None else 'algo.llm')
+    if features is None:
+        _chain = prompt | ALGOLLM.with_structured_output(schema=AlgorithmRecommendations, method='json_schema', strict=True)
+        features = await _chain.ainvoke({'question': question, 'summary': summary})
+    return algo_recommendations(features)
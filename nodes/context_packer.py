@@ -0,0 +1,75 @@
+import re
+import functools
+import tiktoken
+from langchain_core.documents import Document
+
+from constants import BIG_MODEL, CONTEXT_TOKEN_BUDGET, CONTEXT_DEDUPE_OVERLAP
+
+# Packs the filtered splits into the chat context: best first (fused retrieval score x filter confidence),
+# skipping splits that mostly repeat one already packed (RAPTOR summaries of the raw sections, the same
+# recommendation in two guidelines), until the token budget is spent. The packed documents are what gets
+# numbered <doc_#n> in the prompt and streamed to the client, so citations line up.
+
+SHINGLE_SIZE = 5
+DOCUMENT_OVERHEAD_TOKENS = 16  # the <document_#n> wrapper around each document in chat_node
+
+
+@functools.cache
+def encoding():
+    return tiktoken.encoding_for_model(BIG_MODEL)
+
+def count_tokens(text: str):
+    return len(encoding().encode(text, disallowed_special=()))
+
+def shingles(text: str):
+    words = re.findall(r'\w+', text.lower())
+    if len(words) <= SHINGLE_SIZE:
+        return {tuple(words)}
+    return {tuple(words[i:i+SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+def overlap(a: set, b: set):
+    """ Share of the smaller text's shingles found in the other """
+    return len(a & b) / min(len(a), len(b)) if a and b else 0.
+
+def pack_context(documents: list[Document], splits: list[list], retrieval_scores: dict, budget: int = CONTEXT_TOKEN_BUDGET):
+    """ Documents rebuilt from the best non-redundant splits that fit in `budget` tokens, best document first
+
+    `splits` holds each document's kept (split, filter confidence) pairs, in the order the splits appear in the
+    document (the filter returns them that way), so sorting on their index restores the source order.
+    """
+    top_score = max(retrieval_scores.values(), default=0) or 1
+    candidates = [
+        (retrieval_scores.get(document.id, 0) / top_score * confidence, i, j, split)
+        for i, document in enumerate(documents)
+        for j, (split, confidence) in enumerate(splits[i])
+        if split.page_content.strip()
+    ]
+    candidates.sort(key=lambda c: c[0], reverse=True)
+
+    selected, packed_shingles = {}, []
+    used = duplicates = over_budget = 0
+    for score, i, j, split in candidates:
+        split_shingles = shingles(split.page_content)
+        if any(overlap(split_shingles, s) >= CONTEXT_DEDUPE_OVERLAP for s in packed_shingles):
+            duplicates += 1
+            continue
+        cost = count_tokens(split.page_content) + (0 if i in selected else DOCUMENT_OVERHEAD_TOKENS + count_tokens(str(documents[i].metadata.get('Title', ''))))
+        if used + cost > budget:
+            over_budget += 1
+            continue
+        used += cost
+        packed_shingles.append(split_shingles)
+        selected.setdefault(i, {'score': score, 'splits': {}})['splits'][j] = split
+
+    # documents keep the rank of their best split; splits keep their order within the document
+    order = sorted(selected, key=lambda i: selected[i]['score'], reverse=True)
+    packed = [
+        Document(
+            page_content='\n\n'.join(selected[i]['splits'][j].page_content for j in sorted(selected[i]['splits'])),
+            metadata=documents[i].metadata,
+            id=documents[i].id
+        )
+        for i in order
+    ]
+    stats = {'tokens': used, 'budget': budget, 'splits': len(candidates), 'duplicates': duplicates, 'over_budget': over_budget}
+    return packed, stats
@@ -39,10 +39,10 @@ prompt = ChatPromptTemplate.from_messages(
 )
 
 @chain
-def compressor_chain(_input: dict):
+async def compressor_chain(_input: dict):
     return _input['document']  # for now, just return the document as is, no compression
     question, doc = _input['question'], _input['document']
     _chain = prompt | COMPRESSORLLM | StrOutputParser()
-    response = _chain.invoke({'question': question, 'metadata': doc.metadata, 'background': doc.page_content})
+    response = await _chain.ainvoke({'question': question, 'metadata': doc.metadata, 'background': doc.page_content})
     ret = Document(response, metadata=doc.metadata)
     return ret
\ No newline at end of file
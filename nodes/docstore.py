@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import functools
+import pickle
+import sqlite3
+import threading
+import numpy as np
+from typing import Iterator, Optional, Sequence
+from langchain_core.documents import Document
+from langchain_core.stores import BaseStore
+from langchain_community.docstore.base import Docstore
+
+from constants import GUIDELINES
+
+# Read-only, single-file store for a guideline's documents (guideline_pkls/<g>/docstore.sqlite):
+#   docs             parent documents, by doc_id
+#   children         the documents indexed in FAISS, by FAISS row
+#   splits           precomputed markdown splits of each parent
+#   split_embeddings float32 vectors, by split id
+# Metadata keys are interned in `metadata_keys`. SQLite reads are memory-mapped and go through the
+# OS page cache, so workers share one copy and only ever materialise the documents they fetch.
+
+SCHEMA = """
+CREATE TABLE metadata_keys (id INTEGER PRIMARY KEY, name TEXT UNIQUE);
+CREATE TABLE docs (doc_id TEXT PRIMARY KEY, page_content TEXT, metadata TEXT);
+CREATE TABLE children (row INTEGER PRIMARY KEY, docstore_id TEXT UNIQUE, page_content TEXT, metadata TEXT);
+CREATE TABLE splits (doc_id TEXT, position INTEGER, split_id TEXT, page_content TEXT, metadata TEXT, PRIMARY KEY (doc_id, position));
+CREATE TABLE split_embeddings (split_id TEXT PRIMARY KEY, vector BLOB);
+"""
+
+MMAP_SIZE = 256 * 1024 * 1024
+
+
+class GuidelineDocStore(object):
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+        self._keys = dict(self._conn.execute('SELECT id, name FROM metadata_keys').fetchall())
+
+    @property
+    def _conn(self):
+        # sqlite connections can't be shared across threads; reads are cheap to open per thread
+        if not hasattr(self._local, 'conn'):
+            self._local.conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False)
+            self._local.conn.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+        return self._local.conn
+
+    def _document(self, page_content: str, metadata: str, id: str = None):
+        return Document(page_content=page_content, metadata={self._keys[k]: v for k, v in json.loads(metadata)}, id=id)
+
+    def _select_many(self, query: str, keys: Sequence[str]):
+        rows = {}
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i+500]
+            rows.update((r[0], r) for r in self._conn.execute(query.format(','.join('?' * len(batch))), batch))
+        return rows
+
+    def docs(self, doc_ids: Sequence[str]) -> list[Optional[Document]]:
+        rows = self._select_many('SELECT doc_id, page_content, metadata FROM docs WHERE doc_id IN ({})', doc_ids)
+        return [self._document(rows[k][1], rows[k][2], id=k) if k in rows else None for k in doc_ids]
+
+    def doc_ids(self) -> list[str]:
+        return [r[0] for r in self._conn.execute('SELECT doc_id FROM docs ORDER BY rowid')]
+
+    def child(self, docstore_id: str) -> Optional[Document]:
+        row = self._conn.execute('SELECT page_content, metadata FROM children WHERE docstore_id = ?', (docstore_id,)).fetchone()
+        return self._document(*row, id=docstore_id) if row else None
+
+    def index_to_docstore_id(self) -> dict[int, str]:
+        return dict(self._conn.execute('SELECT row, docstore_id FROM children'))
+
+    def splits(self, doc_id: str) -> Optional[list[Document]]:
+        rows = self._conn.execute('SELECT split_id, page_content, metadata FROM splits WHERE doc_id = ? ORDER BY position', (doc_id,)).fetchall()
+        return [self._document(c, m, id=s) for s, c, m in rows] or None
+
+    def split_embedding_count(self) -> int:
+        return self._conn.execute('SELECT COUNT(*) FROM split_embeddings').fetchone()[0]
+
+    def split_embeddings(self, split_ids: Sequence[str]) -> dict[str, np.ndarray]:
+        rows = self._select_many('SELECT split_id, vector FROM split_embeddings WHERE split_id IN ({})', split_ids)
+        return {k: np.frombuffer(v, dtype=np.float32) for k, v in rows.values()}
+
+
+class ParentStore(BaseStore[str, Document]):
+    """ Read-only LangChain store over a guideline's parent documents, for MultiVectorRetriever """
+    def __init__(self, store: GuidelineDocStore) -> None:
+        self.store = store
+
+    def mget(self, keys: Sequence[str]) -> list[Optional[Document]]:
+        return self.store.docs(keys)
+
+    def mset(self, key_value_pairs) -> None:
+        raise NotImplementedError('guideline docstores are read-only; rebuild with build_index.py')
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        raise NotImplementedError('guideline docstores are read-only; rebuild with build_index.py')
+
+    def yield_keys(self, *, prefix: Optional[str] = None) -> Iterator[str]:
+        for k in self.store.doc_ids():
+            if prefix is None or k.startswith(prefix):
+                yield k
+
+
+class ChildDocstore(Docstore):
+    """ Read-only FAISS docstore over a guideline's indexed documents """
+    def __init__(self, store: GuidelineDocStore) -> None:
+        self.store = store
+
+    def search(self, search: str):
+        doc = self.store.child(search)
+        return doc if doc is not None else f'ID {search} not found.'
+
+
+@functools.cache
+def guideline_docstores():
+    """ Docstores of every guideline that has been converted """
+    paths = {g: f'guideline_pkls/{g}/docstore.sqlite' for g in GUIDELINES}
+    return {g: GuidelineDocStore(p) for g, p in paths.items() if os.path.exists(p)}
+
+
+def write_docstore(path, doc_ids, docs, index_to_docstore_id, children, splits=None, split_embeddings=None):
+    tmp_path = f'{path}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    conn.executescript(SCHEMA)
+    keys = {}
+    def interned(metadata: dict):
+        for k in metadata:
+            if k not in keys:
+                keys[k] = len(keys)
+        return json.dumps([[keys[k], v] for k, v in metadata.items()])
+    conn.executemany('INSERT INTO docs VALUES (?, ?, ?)',
+                     [(k, d.page_content, interned(d.metadata)) for k, d in zip(doc_ids, docs)])
+    conn.executemany('INSERT INTO children VALUES (?, ?, ?, ?)',
+                     [(row, k, children[k].page_content, interned(children[k].metadata)) for row, k in index_to_docstore_id.items()])
+    conn.executemany('INSERT INTO splits VALUES (?, ?, ?, ?, ?)',
+                     [(k, i, s.id, s.page_content, interned(s.metadata)) for k, ss in (splits or {}).items() for i, s in enumerate(ss)])
+    conn.executemany('INSERT INTO split_embeddings VALUES (?, ?)',
+                     [(k, np.asarray(v, dtype=np.float32).tobytes()) for k, v in (split_embeddings or {}).items()])
+    conn.executemany('INSERT INTO metadata_keys VALUES (?, ?)', [(i, k) for k, i in keys.items()])
+    conn.commit()
+    conn.execute('VACUUM')
+    conn.close()
+    os.replace(tmp_path, path)
+
+def convert_pickles(pickle_directory):
+    """ Write guideline_pkls/<g>/docstore.sqlite from that guideline's pkl files """
+    directory = f'guideline_pkls/{pickle_directory}'
+    def load(name, default=None):
+        if default is not None and not os.path.exists(f'{directory}/{name}'):
+            return default
+        with open(f'{directory}/{name}', 'rb') as file:
+            return pickle.load(file)
+    faiss_docstore, index_to_docstore_id = load('faiss/index.pkl')
+    children = {k: faiss_docstore.search(k) for k in index_to_docstore_id.values()}
+    write_docstore(f'{directory}/docstore.sqlite', load('doc_ids.pkl'), load('docs.pkl'), index_to_docstore_id, children,
+                   splits=load('splits.pkl', {}), split_embeddings=load('split_embeddings.pkl', {}))
+
+
+if __name__ == '__main__':
+    # python -m nodes.docstore [guideline ...]
+    for g in sys.argv[1:] or GUIDELINES:
+        convert_pickles(g)
+        print(g, 'converted to', f'guideline_pkls/{g}/docstore.sqlite')
@@ -1,31 +1,31 @@
+import os
+import asyncio
+import hashlib
+import pickle
+import logging
+import functools
+import threading
+import numpy as np
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import chain
 from langchain_core.documents import Document
-from langchain_text_splitters import MarkdownHeaderTextSplitter
 
-from llm_response_types import BooleanResponse
+from caching import SQLiteCache
+from llm_response_types import BooleanResponse, ListOfBooleansResponse
 from nodes.contextual_compressor import compressor_chain
-from constants import FILTLLM
-from template import surg_abbrevs_table
-
-headers_to_split_on = [
-    ("#", "Title"),
-    ("##", "Header 1"),
-    ("###", "Header 2"),
-    ("####", "Header 3"),
-    ("#####", "Header 4"),
-    ("######", "Header 5"),
-    ("#######", "Header 6")
-]
-
-markdown_splitter_with_header = MarkdownHeaderTextSplitter(
-    headers_to_split_on=headers_to_split_on,
-    strip_headers=False
-    )
+from nodes.query_embeddings import aembed_queries
+from nodes.docstore import guideline_docstores
+from nodes.splits import split_document
+from constants import FILTLLM, FILTER_BATCH_SIZE, FILTER_PREFILTER_ENABLED, FILTER_PREFILTER_ACCEPT, FILTER_PREFILTER_REJECT, GUIDELINES
+from constants import FILTER_CACHE_PATH, FILTER_CACHE_MAX_ENTRIES, FILTER_CACHE_TTL
+from template import abbreviations_prefix
+
+logger = logging.getLogger(__name__)
 
 sys_template = \
-f"""Use this abbreviations table to help you understand the background information:
-{surg_abbrevs_table}
+f"""{abbreviations_prefix}
+
+Use the abbreviations tables above to help you understand the background information.
 
 Evaluate the <background_document> against the <query>.
 Task: is the <background_document> `relevant` to the query?
@@ -36,59 +36,236 @@ Task: is the <background_document> `relevant` to the query?
 Remember: ONLY use the <background_document> to inform your decision."""
 
 hum_template = \
-"""<background_document>
-{doc_contents}
-</background_document>
-
-<query>
+"""<query>
 {question}
-</query>"""
+</query>
+
+<background_document>
+{doc_contents}
+</background_document>"""
 
 
 filter_prompt = ChatPromptTemplate.from_messages(
     [('system', sys_template),
     ('human', hum_template)])
 
-@chain
-def doc_filter_chain(_input: dict):
-    queries_dict, document = _input['queries_dict'], _input['document']
-    _chain = filter_prompt | FILTLLM.with_structured_output(schema=BooleanResponse, method='json_schema', strict=True)
+sys_template_batch = \
+f"""{abbreviations_prefix}
+
+Use the abbreviations tables above to help you understand the background information.
+
+Evaluate EACH numbered <background_document> against the <query>.
+Task: is each <background_document> `relevant` to the query?
+    - You must consider each ENTITY in the Query.
+    - You must consider each FOCUS/TOPIC of each <background_document>.
+    - A <background_document> is `relevant` if its primary FOCUS contains information pertinent to ANY ONE of the entities in the <query> (including any Examples, Equivalents, Brand Names, Abbreviations, etc.)
+
+Judge every <background_document> independently, using ONLY that <background_document> to inform your decision.
+Return exactly one true/false verdict per <background_document>, in the same order as they are numbered."""
+
+hum_template_batch = \
+"""<query>
+{question}
+</query>
+
+{doc_contents}
+
+There are {n} background documents; return {n} verdicts."""
+
+batch_filter_prompt = ChatPromptTemplate.from_messages(
+    [('system', sys_template_batch),
+    ('human', hum_template_batch)])
+
+# any wording change to the filter prompts invalidates previously cached verdicts
+FILTER_PROMPT_VERSION = hashlib.sha256(f'{sys_template}{hum_template}{sys_template_batch}{hum_template_batch}'.encode()).hexdigest()[:12]
+
+verdict_cache = SQLiteCache(FILTER_CACHE_PATH, FILTER_CACHE_MAX_ENTRIES, ttl=FILTER_CACHE_TTL) if FILTER_CACHE_PATH else None
+
+_filter_chain = filter_prompt | FILTLLM.with_structured_output(schema=BooleanResponse, method='json_schema', strict=True)
+_batch_filter_chain = batch_filter_prompt | FILTLLM.with_structured_output(schema=ListOfBooleansResponse, method='json_schema', strict=True)
+
+
+def _numbered(contents: list):
+    return '\n\n'.join([f'<background_document id={i+1}>\n{c}\n</background_document>' for i, c in enumerate(contents)])
 
-    # split docs and integrate metadata
-    split_docs = markdown_splitter_with_header.split_text(document.page_content)
-    for s in split_docs:
-        s.metadata = {**document.metadata, **{k: v for k, v in s.metadata.items() if k not in document.metadata}}
+async def _classify_each(question: str, contents: list):
+    verdicts = await _filter_chain.abatch([{'question': question, 'doc_contents': c} for c in contents])
+    return [v['b'] for v in verdicts]
+
+async def classify_relevance(question: str, contents: list):
+    """ One relevance verdict per item in contents, FILTER_BATCH_SIZE items per LLM call """
+    if not contents:
+        return []
+    if FILTER_BATCH_SIZE <= 1:
+        return await _classify_each(question, contents)
+    batches = [contents[i:i+FILTER_BATCH_SIZE] for i in range(0, len(contents), FILTER_BATCH_SIZE)]
+    responses = await _batch_filter_chain.abatch([
+        {'question': question, 'doc_contents': _numbered(b), 'n': len(b)}
+        for b in batches])
+    verdicts = []
+    for batch, response in zip(batches, responses):
+        if len(response['l']) == len(batch):
+            verdicts.extend(response['l'])
+        else:
+            # the model miscounted, so the verdicts can't be lined up; judge this batch one by one
+            verdicts.extend(await _classify_each(question, batch))
+    return verdicts
+
+def _verdict_key(question: str, split: Document, filter_pass: str):
+    normalized = ' '.join(question.lower().split())
+    key = f'{normalized}|{split.id}|{filter_pass}|{FILTER_PROMPT_VERSION}|{FILTLLM.model_name}'
+    return hashlib.sha256(key.encode()).hexdigest()
+
+async def cached_classify_relevance(question: str, splits: list[Document], contents: list, filter_pass: str, stats: dict):
+    """ classify_relevance, reusing verdicts previously given for the same query, split, pass, prompt and model """
+    if verdict_cache is None:
+        return await classify_relevance(question, contents)
+    keys = [_verdict_key(question, s, filter_pass) for s in splits]
+    verdicts = await asyncio.to_thread(verdict_cache.get_many, keys)
+    missing = [j for j, v in enumerate(verdicts) if v is None]
+    stats['cache_hits'] += len(keys) - len(missing)
+    stats['cache_misses'] += len(missing)
+    if missing:
+        fresh = await classify_relevance(question, [contents[j] for j in missing])
+        for j, v in zip(missing, fresh):
+            verdicts[j] = v
+        await asyncio.to_thread(verdict_cache.set_many, {keys[j]: verdicts[j] for j in missing})
+    return verdicts
+
+
+# splits and split embeddings are computed offline, never on the request path, and loaded on first use:
+#   python build_index.py    (embeds the splits of every guideline and writes them into its docstore.sqlite)
+# the shipped stores have no split embeddings, so the similarity prefilter is off (FILTER_PREFILTER_ENABLED)
+# until they're built; a split without an embedding goes to FILTLLM
+def _load_guideline_pkl(pickle_directory, name):
+    path = f'guideline_pkls/{pickle_directory}/{name}'
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as file:
+        return pickle.load(file)
+
+# converted guidelines are read from their docstore.sqlite by id; the rest from their pkl files
+@functools.cache
+def precomputed_splits():
+    return {k: v for g in GUIDELINES if g not in guideline_docstores() for k, v in _load_guideline_pkl(g, 'splits.pkl').items()}
+
+@functools.cache
+def split_embeddings():
+    return {k: v for g in GUIDELINES if g not in guideline_docstores() for k, v in _load_guideline_pkl(g, 'split_embeddings.pkl').items()}
+
+def check_split_embeddings():
+    docstores = guideline_docstores()
+    counts = {g: docstores[g].split_embedding_count() if g in docstores else len(_load_guideline_pkl(g, 'split_embeddings.pkl'))
+              for g in GUIDELINES}
+    missing = [g for g, n in counts.items() if not n]
+    if missing:
+        logger.warning('no split embeddings for %s: the filter prefilter is off for them and all their splits go to FILTLLM; '
+                       'generate them with `python build_index.py %s`', ', '.join(missing), ' '.join(missing))
+    return counts
+
+def preload_split_stores():
+    """ Start loading the precomputed splits and their embeddings in a background thread """
+    if FILTER_PREFILTER_ENABLED:
+        threading.Thread(target=lambda: (precomputed_splits(), split_embeddings(), check_split_embeddings()), daemon=True).start()
+    else:
+        threading.Thread(target=precomputed_splits, daemon=True).start()
+
+def get_splits(document: Document):
+    for store in guideline_docstores().values():
+        splits = store.splits(document.id)
+        if splits is not None:
+            return splits
+    splits = precomputed_splits().get(document.id)
+    return splits if splits is not None else split_document(document)
+
+def get_split_embeddings(split_ids: list[str]):
+    embeddings = {k: split_embeddings()[k] for k in split_ids if k in split_embeddings()}
+    for store in guideline_docstores().values():
+        embeddings.update(store.split_embeddings(split_ids))
+    return embeddings
+
+async def prefilter_scores(queries_dict: dict, splits: list[Document]):
+    """ Best cosine similarity of each split against the request's queries; None if the split has no embedding """
+    # these are the same queries retrieval just embedded, so this is a cache hit
+    query_vectors = np.stack(await aembed_queries([q for q in queries_dict.values() if q]))
+    query_vectors /= np.linalg.norm(query_vectors, axis=1, keepdims=True)
+    embeddings = await asyncio.to_thread(get_split_embeddings, [s.id for s in splits])
+    scores = []
+    for s in splits:
+        v = embeddings.get(s.id)
+        scores.append(None if v is None else float(np.max(query_vectors @ v) / np.linalg.norm(v)))
+    return scores
+
+# how sure the filter is of a split, by the stage that kept it
+FILTER_CONFIDENCE = {'similarity': 1.0, 'metadata': 0.8, 'full_text': 0.6}
+
+async def filter_documents(documents: list[Document], queries_dict: dict):
+    """ Keep only the relevant splits of each document, classifying the splits of all documents together
+
+    Returns the filtered documents, the stats, and each document's kept (split, confidence) pairs, in document order.
+    """
+    question = queries_dict['rephrased']
+    split_docs = await asyncio.to_thread(lambda: [get_splits(d) for d in documents])
+    # keyed by (document, position of the split in it)
+    all_splits = [((i, j), s) for i, doc_splits in enumerate(split_docs) for j, s in enumerate(doc_splits)]
+
+    # clear cut splits are decided locally by embedding similarity; only the middle band goes to the LLM
+    scores = await prefilter_scores(queries_dict, [s for _, s in all_splits]) if FILTER_PREFILTER_ENABLED else [None] * len(all_splits)
+    accepted_on_similarity = [(k, s) for (k, s), sc in zip(all_splits, scores) if sc is not None and sc >= FILTER_PREFILTER_ACCEPT]
+    splits = [(k, s) for (k, s), sc in zip(all_splits, scores) if sc is None or FILTER_PREFILTER_REJECT <= sc < FILTER_PREFILTER_ACCEPT]
+    stats = {
+        'auto_accepted': len(accepted_on_similarity),
+        'auto_rejected': len(all_splits) - len(accepted_on_similarity) - len(splits),
+        'llm_judged': len(splits),
+        'cache_hits': 0,
+        'cache_misses': 0
+    }
 
     # filter based on metadata only. keep YES, continue to filter NO based on full text
-    metadata_filter = _chain.batch([
-        {
-            'question': queries_dict['rephrased'],
-            'doc_contents': s.metadata
-        }
-        for s in split_docs])
-    print(metadata_filter)
-    rejected_splits_on_metadata = [s for s, f in zip(split_docs, metadata_filter) if not f['b']]
-    filtered_on_metadata = [s for s, f in zip(split_docs, metadata_filter) if f['b']]
-    
+    metadata_filter = await cached_classify_relevance(
+        question, [s for _, s in splits], [str(s.metadata) for _, s in splits], 'metadata', stats)
+    filtered_on_metadata = [(k, s) for (k, s), f in zip(splits, metadata_filter) if f]
+    rejected_splits_on_metadata = [(k, s) for (k, s), f in zip(splits, metadata_filter) if not f]
+
     # filter rejected docs, now based on full text
     compressed_filtered_on_doc = []
     if rejected_splits_on_metadata:
-        doc_filter = _chain.batch([
-            {
-                'question': queries_dict['rephrased'],
-                'doc_contents': f'Document metadata:\n{s.metadata}\n\nDocument:\n{s.page_content}'
-            }
-            for s in rejected_splits_on_metadata])
-        raw_filtered_on_doc = [s for s, f in zip(rejected_splits_on_metadata, doc_filter) if f['b']]
-        compressed_filtered_on_doc = compressor_chain.batch([
-            {'question': queries_dict['rephrased'], 
-            'document': s} 
-            for s in raw_filtered_on_doc])
-    
+        doc_filter = await cached_classify_relevance(
+            question,
+            [s for _, s in rejected_splits_on_metadata],
+            [f'Document metadata:\n{s.metadata}\n\nDocument:\n{s.page_content}' for _, s in rejected_splits_on_metadata],
+            'full_text', stats)
+        raw_filtered_on_doc = [(k, s) for (k, s), f in zip(rejected_splits_on_metadata, doc_filter) if f]
+        compressed = await compressor_chain.abatch([
+            {'question': question,
+            'document': s}
+            for _, s in raw_filtered_on_doc])
+        compressed_filtered_on_doc = [(k, c) for (k, _), c in zip(raw_filtered_on_doc, compressed)]
+
     # reconstruct docs
-    filtered_docs = filtered_on_metadata + compressed_filtered_on_doc
-    filtered = Document(
-        page_content='\n\n'.join([s.page_content for s in filtered_docs]),
-        metadata=document.metadata
-    )
-    return filtered
\ No newline at end of file
+    kept = [[] for _ in documents]
+    for stage, stage_splits in [('similarity', accepted_on_similarity), ('metadata', filtered_on_metadata), ('full_text', compressed_filtered_on_doc)]:
+        for (i, j), s in stage_splits:
+            kept[i].append((j, s, FILTER_CONFIDENCE[stage]))
+    # back in document order, whichever stage kept them
+    kept = [[(s, confidence) for _, s, confidence in sorted(doc_kept, key=lambda x: x[0])] for doc_kept in kept]
+    filtered = []
+    for i, document in enumerate(documents):
+        filtered.append(Document(
+            page_content='\n\n'.join([s.page_content for s, _ in kept[i]]),
+            metadata=document.metadata,
+            id=document.id
+        ))
+    return filtered, stats, kept
+
+@chain
+async def doc_filter_chain(_input: dict):
+    queries_dict, document = _input['queries_dict'], _input['document']
+    filtered, _, _ = await filter_documents([document], queries_dict)
+    return filtered[0]
+
+@chain
+async def docs_filter_chain(_input: dict):
+    queries_dict, documents = _input['queries_dict'], _input['documents']
+    filtered, stats, splits = await filter_documents(documents, queries_dict)
+    return {'documents': filtered, 'stats': stats, 'splits': splits}
@@ -1,12 +1,12 @@
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import chain, RunnableParallel
-from langchain.load import dumps, loads
+from langchain_core.documents import Document
 from llm_response_types import StringResponse, ListOfStringsResponse
-from template import meds_abbrevs_table, surg_abbrevs_table
+from template import abbreviations_prefix
 from constants import MULTIQUERYLLM, REPHRASINGLLM, REORGLLM
 
 
-sys_template_root = f"ABBREVIATIONS\n\n{meds_abbrevs_table}\n\n{surg_abbrevs_table}\nEND OF ABBREVIATIONS"
+sys_template_root = abbreviations_prefix
 
 sys_template_multi = f"""{sys_template_root}
 
@@ -83,66 +83,66 @@ def recs_string(tx_options: dict):
         strings.append(f'Based solely on the patient\'s interest in preservation of sexual function (including erectile & ejaculatory function), guidelines recommend {_flatten(tx_options["q_s"])}')
     return '\n\n'.join(strings)
 
-def _rephrase_reorganize_chain(_input: dict):
+async def _rephrase_reorganize_chain(_input: dict):
     # gpt-4o
     _rephrase_chain = rephrase_prompt | REPHRASINGLLM.with_structured_output(schema=StringResponse, method='json_schema', strict=True)
     # gpt-4o-mini
     _reorg_chain = reorg_prompt | REORGLLM.with_structured_output(schema=StringResponse, method='json_schema', strict=True)
     # run chains
-    _rephrased = _rephrase_chain.invoke(_input)['s']
-    _reorg = _reorg_chain.invoke({'original_prompt': _input['question'], 'rephrased': _rephrased})['s']
+    _rephrased = (await _rephrase_chain.ainvoke(_input))['s']
+    _reorg = (await _reorg_chain.ainvoke({'original_prompt': _input['question'], 'rephrased': _rephrased}))['s']
     return {'rephrased': _rephrased, 'reorganized': _reorg}
-        
+
+def assemble_queries(question: str, summary: str, treatments: str, multi: list[str], rephrased: str, reorganized: str):
+    return {**{f'q{i+1}':q for i, q in enumerate(multi)}, 'rephrased': rephrased, 'reorganized': reorganized, 'original': f"Query: {question}\n\n{treatments}\n\n{summary}"}
+
 @chain
-def generate_queries(_input: dict):
+async def generate_queries(_input: dict):
     q_raw, summary, _tx_options = _input['question'], _input['summary'], _input['tx_options']
     treatments = recs_string(_tx_options)
 
     _multi_chain = multi_prompt | MULTIQUERYLLM.with_structured_output(schema=ListOfStringsResponse, method='json_schema', strict=True)
 
     _chain = RunnableParallel(mc=_multi_chain, rc=_rephrase_reorganize_chain)
-    _qs = _chain.invoke({'question': q_raw, 'summary': summary, 'treatments': treatments})
+    _qs = await _chain.ainvoke({'question': q_raw, 'summary': summary, 'treatments': treatments})
     
-    _qs_multi = _qs['mc']['l']
-    _qs_rephrase = _qs['rc']['rephrased']
-    _qs_reorg = _qs['rc']['reorganized']
+    return assemble_queries(q_raw, summary, treatments, _qs['mc']['l'], _qs['rc']['rephrased'], _qs['rc']['reorganized'])
+
 
-    qs = {**{f'q{i+1}':q for i, q in enumerate(_qs_multi)}, 'rephrased': _qs_rephrase, 'reorganized': _qs_reorg, 'original': f"Query: {q_raw}\n\n{treatments}\n\n{summary}"}
-    return qs
+def doc_key(doc: Document):
+    # guideline docs carry their docstore doc_id; fall back to content for anything else
+    return doc.id if doc.id is not None else doc.page_content
 
 
 def get_unique_union(documents: list[list]):
     """ Unique union of retrieved docs """
-    # Flatten list of lists, and convert each Document to string
-    flattened_docs = [dumps(doc) for sublist in documents for doc in sublist]
-    # Get unique documents
-    unique_docs = list(set(flattened_docs))
-    # Return
-    return [loads(doc) for doc in unique_docs]
+    # Flatten list of lists, keeping the first occurrence of each document
+    unique_docs = {}
+    for sublist in documents:
+        for doc in sublist:
+            unique_docs.setdefault(doc_key(doc), doc)
+    return list(unique_docs.values())
 
 
 def reciprocal_rank_fusion(results: list[list], k=60):
     fused_scores = {}
+    fused_docs = {}
 
     # Iterate through each list of ranked documents
     for docs in results:
         # Iterate through each document in the list, with its rank (position in the list)
         for rank, doc in enumerate(docs):
-            # Convert the document to a string format to use as a key (assumes documents can be serialized to JSON)
-            doc_str = dumps(doc)
+            key = doc_key(doc)
             # If the document is not yet in the fused_scores dictionary, add it with an initial score of 0
-            if doc_str not in fused_scores:
-                fused_scores[doc_str] = 0
-            # Retrieve the current score of the document, if any
-            previous_score = fused_scores[doc_str]
+            if key not in fused_scores:
+                fused_scores[key] = 0
+                fused_docs[key] = doc
             # Update the score of the document using the RRF formula: 1 / (rank + k)
-            fused_scores[doc_str] += 1 / (rank + k)
+            fused_scores[key] += 1 / (rank + k)
 
     # Sort the documents based on their fused scores in descending order to get the final reranked results
-    reranked_results = [
-        (loads(doc), score)
-        for doc, score in sorted(fused_scores.items(), key=lambda x: x[1], reverse=True)
-    ]
-
-    # Return the reranked results as a list of tuples, each containing the document and its fused score
-    return [d for d,_ in reranked_results]
\ No newline at end of file
+    # Return the reranked results as a list of tuples, each containing the original document and its fused score
+    return [
+        (fused_docs[key], score)
+        for key, score in sorted(fused_scores.items(), key=lambda x: x[1], reverse=True)
+    ]
\ No newline at end of file
@@ -0,0 +1,35 @@
+import asyncio
+import numpy as np
+
+from caching import LRUCache, SQLiteCache, encode_vector, decode_vector
+from constants import EMBD, QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_CACHE_PATH, QUERY_EMBEDDING_CACHE_MAX_ENTRIES
+
+# one embedding per distinct query, shared by every guideline index and reused across requests;
+# the in-memory LRU is backed by SQLite when a path is set, so new entries are written one row at a time
+query_embedding_cache = LRUCache(QUERY_EMBEDDING_CACHE_SIZE)
+query_embedding_store = SQLiteCache(QUERY_EMBEDDING_CACHE_PATH, QUERY_EMBEDDING_CACHE_MAX_ENTRIES, table='query_embeddings') if QUERY_EMBEDDING_CACHE_PATH else None
+
+
+def normalize_query(query: str):
+    return ' '.join(query.split())
+
+async def aembed_queries(queries: list[str]):
+    """ Embed all queries with a single batched call, skipping any already cached """
+    keys = [normalize_query(q) for q in queries]
+    vectors = {k: query_embedding_cache.get(k) for k in keys}
+    missing = [k for k, v in vectors.items() if v is None]
+    if missing and query_embedding_store is not None:
+        stored = await asyncio.to_thread(query_embedding_store.get_many, missing)
+        for k, v in zip(missing, stored):
+            if v is not None:
+                vectors[k] = decode_vector(v)
+                query_embedding_cache.set(k, vectors[k])
+        missing = [k for k in missing if vectors[k] is None]
+    if missing:
+        embedded = await EMBD.aembed_documents(missing)
+        for k, v in zip(missing, embedded):
+            vectors[k] = np.asarray(v, dtype=np.float32)
+            query_embedding_cache.set(k, vectors[k])
+        if query_embedding_store is not None:
+            await asyncio.to_thread(query_embedding_store.set_many, {k: encode_vector(vectors[k]) for k in missing})
+    return [vectors[k] for k in keys]
@@ -0,0 +1,78 @@
+from typing import List
+from typing_extensions import TypedDict, Annotated, Literal
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import chain
+
+from nodes.routingagent import rule_route
+from nodes.algoreader import extract_features, algo_recommendations
+from nodes.multiretriever import recs_string, assemble_queries
+from template import abbreviations_prefix
+from constants import QUERYLLM
+
+# One structured call standing in for the router, the algorithm reader and the query generators.
+# The treatment options can't feed the subquestions here (they come out of the same call),
+# so they only reach retrieval through the 'original' query, as in the multi-call path.
+
+
+sys_template = \
+f"""{abbreviations_prefix}
+
+You are part of an AI team that helps users find information about benign prostate hyperplasia (BPH).
+Given the user query and the conversation context, fill in every field of the structured response:
+
+use_guidelines: is the query about BPH and therefore requires information from a BPH knowledge base? That is, the query is or could be about BPH, including definitions, symptoms, diagnosis, testing, management, treatment, related medications/medical therapy, surgical therapy, complications, side effects, or other topics broadly related to BPH.
+
+size, q_s, q_m, q_b: the patient's details, as described for each field.
+
+subquestions: subquestions generated from the query.
+- One subquestion per ENTITY from the query
+- Each entity should be referred to by all of its names and abbreviations, per the tables provided.
+
+rephrased: the query, rephrased to maximize retrieval in a vector search.
+- Rephrase the question to be as clear and concise as possible, while still covering the full scope of the original question.
+- The rephrased question should be a single query that encompasses all the information/treatments in the original question.
+- Expand all abbreviations, then include all known names/abbreviations/examples/equivalents/brand names of each treatment, using the tables.
+
+reorganized: the rephrased query, rewritten so that like items are grouped and equivalent terms are combined.
+- Match the intent of the original query. In one line, no formatting. Don't get creative."""
+
+hum_template = \
+"""Conversation Context:
+```{summary}```
+
+Query: {question}"""
+
+
+class QueryUnderstanding(TypedDict):
+    use_guidelines: bool
+    size: Annotated[Literal['None', '<30cc', '30-80cc', '>80cc'], ..., 'the size of the prostate if available in the query']
+    q_s: Annotated[bool, ..., "is the user concerned about or interested in preservation of sexual function, including erectile and/or ejaculatory function?"]
+    q_m: Annotated[bool, ..., "is the user medically complicated (excluding bleeding risk), i.e. unfit or cannot have anesthesia for any reason?"]
+    q_b: Annotated[bool, ..., "is the user at risk for bleeding or post procedural hematuria, such as patients on anticoagulation or antiplatelet therapy?"]
+    subquestions: List[str]
+    rephrased: str
+    reorganized: str
+
+
+prompt = ChatPromptTemplate.from_messages(
+    [
+        ('system', sys_template),
+        ('human', hum_template)
+    ]
+)
+
+@chain
+async def query_understanding_chain(_input: dict):
+    question, summary = _input['question'], _input['summary']
+    _chain = prompt | QUERYLLM.with_structured_output(schema=QueryUnderstanding, method='json_schema', strict=True)
+    _llmresp = await _chain.ainvoke({'question': question, 'summary': summary})
+    # clear-cut local reads win over the model's, as they do in the multi-call path
+    features = extract_features(question, summary) or {k: _llmresp[k] for k in ('size', 'q_s', 'q_m', 'q_b')}
+    algo = algo_recommendations(features)
+    queries = assemble_queries(question, summary, recs_string(algo['metadata']),
+                               _llmresp['subquestions'], _llmresp['rephrased'], _llmresp['reorganized'])
+    return {
+        'use_guidelines': bool(rule_route(question, summary)) or _llmresp['use_guidelines'],
+        'algo': algo,
+        'queries': queries
+    }
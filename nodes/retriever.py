@@ -1,44 +1,168 @@
 import os
+import asyncio
 import pickle
-from langchain.storage import InMemoryByteStore
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import faiss
+import numpy as np
+from langchain.storage import InMemoryStore
 from langchain_community.vectorstores import FAISS  
 from langchain.retrievers.multi_vector import MultiVectorRetriever
 from langchain.retrievers.multi_vector import SearchType
-from constants import EMBD, RETRIEVAL_TOP_K
+from nodes.docstore import guideline_docstores, ParentStore, ChildDocstore
+from constants import EMBD, RETRIEVAL_TOP_K, GUIDELINES, UNIFIED_GUIDELINE_INDEX
 
-# note: the guideline documents are saved as and loaded from pkl files, but not generated in this repo
-# currenly they're being generated in RAG_BPH/md_test.ipynb, using cua.md, aua.md, and eau.md
+# note: the guideline documents are built offline with build_index.py, as pkl files converted to a docstore.sqlite
+# the current ones were generated in RAG_BPH/md_test.ipynb, using cua.md, aua.md, and eau.md
 # documents include raw segmented chunks (by markdown headers) and RAPTOR recursive summaries for each guideline
 # guidelines are generated from parsed pdfs and manually cleaned up prior to chunking and summarization
 
-def get_retriever(pickle_directory, top_k=RETRIEVAL_TOP_K):
+# the flat vectors are memory-mapped rather than read in, so workers share the OS page cache
+FAISS_IO_FLAGS = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+
+def load_faiss_index(faiss_directory):
+    if not os.path.isdir(faiss_directory):
+        # never embed the corpus on the serving path; the index has to be built offline
+        raise FileNotFoundError(f'No FAISS index at {faiss_directory}, build it with build_index.py')
+    return faiss.read_index(f'{faiss_directory}/index.faiss', FAISS_IO_FLAGS)
+
+def load_pickled_stores(pickle_directory):
+    # legacy layout; convert with `python -m nodes.docstore` to avoid unpickling in every worker
     with open(f'guideline_pkls/{pickle_directory}/doc_ids.pkl', 'rb') as file:
         doc_ids = pickle.load(file)
-    with open(f'guideline_pkls/{pickle_directory}/summary_docs.pkl', 'rb') as file:
-        summary_docs = pickle.load(file)
     with open(f'guideline_pkls/{pickle_directory}/docs.pkl', 'rb') as file:
         docs = pickle.load(file)
+    with open(f'guideline_pkls/{pickle_directory}/faiss/index.pkl', 'rb') as file:
+        faiss_docstore, index_to_docstore_id = pickle.load(file)
+
+    # keep the Documents as objects (not serialized bytes), tagged with their doc_id,
+    # so retrieval hands back the originals and fusion can key on the id
+    for doc_id, doc in zip(doc_ids, docs):
+        doc.id = doc_id
+    store = InMemoryStore()
+    store.mset(list(zip(doc_ids, docs)))
+    return store, faiss_docstore, index_to_docstore_id
+
+def load_guideline_stores(pickle_directory):
+    """ A guideline's FAISS index, parent document store, and the FAISS docstore with its row -> id mapping """
+    index = load_faiss_index(f'guideline_pkls/{pickle_directory}/faiss')
+    docstores = guideline_docstores()
+    if pickle_directory in docstores:
+        # documents are fetched from sqlite by id, already tagged with their doc_id
+        store = docstores[pickle_directory]
+        return index, ParentStore(store), ChildDocstore(store), store.index_to_docstore_id()
+    return index, *load_pickled_stores(pickle_directory)
 
-    if not os.path.isdir(f'guideline_pkls/{pickle_directory}/faiss'):
-        vectorstore = FAISS.from_documents(summary_docs, EMBD)
-        vectorstore.save_local(f'guideline_pkls/{pickle_directory}/faiss')
-    else:
-        vectorstore = FAISS.load_local(f'guideline_pkls/{pickle_directory}/faiss', EMBD, allow_dangerous_deserialization=True)
+def get_retriever(pickle_directory, top_k=RETRIEVAL_TOP_K):
+    index, parent_store, faiss_docstore, index_to_docstore_id = load_guideline_stores(pickle_directory)
+    vectorstore = FAISS(EMBD, index, faiss_docstore, index_to_docstore_id)
 
-    store = InMemoryByteStore()
     id_key = 'doc_id'
     retriever = MultiVectorRetriever(
         vectorstore=vectorstore,
-        byte_store=store,
+        docstore=parent_store,
         id_key=id_key,
         search_type=SearchType.similarity,
         search_kwargs={'k': top_k}
     )
-    retriever.docstore.mset(list(zip(doc_ids, docs)))
     return retriever
 
-guideline_retrievers = {
-    'cua': get_retriever('cua'),
-    'aua': get_retriever('aua'),
-    'eau': get_retriever('eau')
-}
\ No newline at end of file
+async def asearch_by_vector(retriever: MultiVectorRetriever, embedding):
+    # same as the retriever's own lookup, but from a precomputed query embedding
+    sub_docs = await retriever.vectorstore.asimilarity_search_by_vector(embedding, **retriever.search_kwargs)
+    ids = []
+    for d in sub_docs:
+        if retriever.id_key in d.metadata and d.metadata[retriever.id_key] not in ids:
+            ids.append(d.metadata[retriever.id_key])
+    docs = await retriever.docstore.amget(ids)
+    return [d for d in docs if d is not None]
+
+async def asearch_by_vectors(retriever: MultiVectorRetriever, embeddings: list):
+    return await asyncio.gather(*[asearch_by_vector(retriever, e) for e in embeddings])
+
+
+class UnifiedGuidelineIndex(object):
+    """ A single flat index over every guideline's summary docs, each row tagged with its guideline """
+    id_key = 'doc_id'
+
+    def __init__(self, guidelines: list[str], top_k=RETRIEVAL_TOP_K) -> None:
+        # the per-guideline indexes are only read to copy their vectors in; just the parent stores are kept
+        self.docstores = {}
+        self.top_k = top_k
+        self.row_guidelines = []
+        self.row_doc_ids = []
+        vectors = []
+        for guideline in guidelines:
+            index, parent_store, faiss_docstore, index_to_docstore_id = load_guideline_stores(guideline)
+            self.docstores[guideline] = parent_store
+            vectors.append(index.reconstruct_n(0, index.ntotal))
+            for i in range(index.ntotal):
+                sub_doc = faiss_docstore.search(index_to_docstore_id[i])
+                self.row_guidelines.append(guideline)
+                self.row_doc_ids.append(sub_doc.metadata.get(self.id_key))
+        vectors = np.concatenate(vectors)
+        self.index = faiss.IndexFlatL2(vectors.shape[1])
+        self.index.add(vectors)
+
+    def search(self, embeddings: list):
+        """ One batched k-NN pass over all queries; returns {guideline: [doc ids per query]} """
+        # ranking every row costs the same as ranking k of them on a flat index,
+        # and guarantees each guideline gets its full top_k
+        _, rows = self.index.search(np.asarray(embeddings, dtype=np.float32), self.index.ntotal)
+        results = {g: [] for g in self.docstores}
+        for query_rows in rows:
+            per_guideline = {g: [] for g in self.docstores}
+            hits = {g: 0 for g in self.docstores}
+            for row in query_rows:
+                guideline, doc_id = self.row_guidelines[row], self.row_doc_ids[row]
+                if hits[guideline] == self.top_k:
+                    continue
+                hits[guideline] += 1
+                if doc_id is not None and doc_id not in per_guideline[guideline]:
+                    per_guideline[guideline].append(doc_id)
+            for g, ids in per_guideline.items():
+                results[g].append(ids)
+        return results
+
+    async def asearch(self, embeddings: list):
+        ids = await asyncio.to_thread(self.search, embeddings)
+        results = {}
+        for guideline, ids_per_query in ids.items():
+            docstore = self.docstores[guideline]
+            docs = await asyncio.gather(*[docstore.amget(i) for i in ids_per_query])
+            results[guideline] = [[d for d in ds if d is not None] for ds in docs]
+        return results
+
+
+# --- lazy loading ---
+# nothing is loaded at import; stores load on first use, or ahead of time via preload_guideline_stores
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_guideline_retrievers():
+    with _stores_lock:
+        if 'retrievers' not in _stores:
+            with ThreadPoolExecutor(max_workers=len(GUIDELINES)) as pool:
+                _stores['retrievers'] = dict(zip(GUIDELINES, pool.map(get_retriever, GUIDELINES)))
+        return _stores['retrievers']
+
+def get_unified_index():
+    # loaded instead of, not alongside, the per-guideline retrievers
+    with _stores_lock:
+        if 'unified_index' not in _stores:
+            _stores['unified_index'] = UnifiedGuidelineIndex(GUIDELINES)
+        return _stores['unified_index']
+
+def preload_guideline_stores():
+    """ Start loading the guideline stores in a background thread """
+    load = get_unified_index if UNIFIED_GUIDELINE_INDEX else get_guideline_retrievers
+    threading.Thread(target=load, daemon=True).start()
+
+async def asearch_guidelines(embeddings: list):
+    """ Per-guideline, per-query parent documents for each query embedding """
+    if UNIFIED_GUIDELINE_INDEX:
+        unified_index = await asyncio.to_thread(get_unified_index)
+        return await unified_index.asearch(embeddings)
+    guideline_retrievers = await asyncio.to_thread(get_guideline_retrievers)
+    results = await asyncio.gather(*[asearch_by_vectors(r, embeddings) for r in guideline_retrievers.values()])
+    return dict(zip(guideline_retrievers, results))
\ No newline at end of file
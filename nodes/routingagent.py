@@ -1,35 +1,93 @@
+import re
 from langchain_core.prompts import ChatPromptTemplate
 
 from llm_response_types import BooleanResponse
 from constants import ROUTERLLM
-from template import meds_abbrevs_table, surg_abbrevs_table, other_abbrevs_table
+from template import abbreviations_prefix, meds_abbrevs_table, surg_abbrevs_table, other_abbrevs_table
 
 
 router_template = \
-f"""<related_terms>
-{meds_abbrevs_table}
+f"""{abbreviations_prefix}
 
-{surg_abbrevs_table}
+Evaluate the user query, using the conversation summary and the tables above. Is it about benign prostate hyperplasia (BPH) and therefore requires information from a BPH knowledge base?
 
-{other_abbrevs_table}
-</related_terms>
+You would want to use the BPH knowledge base, if:
+the user query is or could be about benign prostate hyperplasia (BPH), including definitions, symptoms, diagnosis, testing, management, treatment, related medications/medical therapy, surgical therapy, complications, side effects, or other topics broadly related to BPH."""
 
-<conversation_summary>
-{{summary}}
+hum_template = \
+"""<conversation_summary>
+{summary}
 </conversation_summary>
 
-Evaluate the user query. Is it about benign prostate hyperplasia (BPH) and therefore requires information from a BPH knowledge base?
-
-You would want to use the BPH knowledge base, if:
-the user query is or could be about benign prostate hyperplasia (BPH), including definitions, symptoms, diagnosis, testing, management, treatment, related medications/medical therapy, surgical therapy, complications, side effects, or other topics broadly related to BPH."""
+Query: {question}"""
 
 
 router_prompt = ChatPromptTemplate.from_messages(
     [
         ('system', router_template),
-        ('human', 'Query: {question}')
+        ('human', hum_template)
     ]
 
 )
 
-router_chain = router_prompt | ROUTERLLM.with_structured_output(schema=BooleanResponse, method='json_schema', strict=True)
\ No newline at end of file
+router_chain = router_prompt | ROUTERLLM.with_structured_output(schema=BooleanResponse, method='json_schema', strict=True)
+
+
+# --- local fast path ---
+# Queries naming a BPH-specific term are routed to the guidelines without asking ROUTERLLM.
+# Terms that also come up outside BPH (prostate, finasteride, urinary retention, PSA, WAVE, laser enucleation, ...)
+# only count when the query or the conversation so far has BPH context: a BPH-specific term, or 'enlarged'.
+# Anything else is left to the LLM.
+BPH_LEXICON = [
+    'prostatectomy', 'hyperplasia', 'enlarged prostate', 'prostate enlargement', 'urolift', 'rezum', 'aquablation',
+    'bph', 'luts', 'turp', 'holep', 'thulep', 'ipss', '5-ari',
+]
+# entries of other_abbrevs_table that are specific enough to BPH on their own
+BPH_ABBREVIATIONS = ['AUA-SI', 'BPE', 'BPH', 'BPO', 'IPSS', 'LUTS', 'LUTS/BPH', 'MTOPS']
+# entries of surg_abbrevs_table that mean something else often enough to need BPH context
+AMBIGUOUS_SURGICAL_TERMS = ['LSP', 'MIST', 'OSP', 'PAE', 'PUL', 'PVP', 'RASP', 'RWT', 'TIPD', 'TUNA', 'WAVE',
+                            'Laser vaporisation', 'Laser enucleation', 'Minimally Invasive Surgical Therapies']
+# terms with common uses outside BPH (hair loss, childbirth, kidney stones, ...)
+WEAK_LEXICON = [
+    'prostate', 'prostatic', 'prostatitis', 'enucleation', 'greenlight', 'urinary retention', 'nocturia', 'weak stream',
+    'lower urinary tract', 'bladder outlet', 'post-void', 'finasteride', 'dutasteride', 'alpha reductase', 'alpha-reductase',
+    'tamsulosin', 'silodosin', 'alfuzosin', 'doxazosin', 'terazosin', 'alpha blocker', 'alpha-blocker',
+]
+CONTEXT_LEXICON = ['enlarged', 'enlargement']
+
+def table_terms(table: str, abbreviations: list[str] = None):
+    """ Abbreviations and their expansions; only the rows of `abbreviations` if given """
+    terms = []
+    for row in table.splitlines():
+        cells = [c.strip() for c in row.strip('|').split('|')]
+        if len(cells) != 2 or cells[0] in ('Abbrev.', 'Term') or set(cells[0]) <= {'-'}:
+            continue
+        if abbreviations is not None and cells[0] not in abbreviations:
+            continue
+        terms.append(cells[0])
+        terms.extend(t.strip() for t in cells[1].split(','))
+    return terms
+
+def term_pattern(terms: list[str]):
+    # abbreviations are matched as written (so 'RE' isn't 're'), longer terms in any case
+    abbreviations = sorted({t for t in terms if not t.islower() and len(t) <= 8 and ' ' not in t}, key=len, reverse=True)
+    words = sorted({t.lower() for t in terms} - {t.lower() for t in abbreviations} | {t for t in terms if t.islower()}, key=len, reverse=True)
+    alternatives = [re.escape(t) for t in abbreviations] + [f'(?i:{re.escape(t)})' for t in words]
+    return re.compile(r'(?<![\w-])(?:' + '|'.join(alternatives) + r')s?(?![\w-])')
+
+_surg_terms = table_terms(surg_abbrevs_table)
+_strong = ([t for t in _surg_terms if t not in AMBIGUOUS_SURGICAL_TERMS] + BPH_LEXICON + BPH_ABBREVIATIONS
+           + table_terms(other_abbrevs_table, BPH_ABBREVIATIONS))
+strong_terms = term_pattern(_strong)
+weak_terms = term_pattern(AMBIGUOUS_SURGICAL_TERMS + WEAK_LEXICON + table_terms(meds_abbrevs_table) + table_terms(other_abbrevs_table))
+context_terms = term_pattern(_strong + CONTEXT_LEXICON)
+
+def rule_route(question: str, summary: str = ''):
+    """ Terms that make the query about BPH without asking the LLM; empty if it isn't clear cut """
+    strong = strong_terms.findall(question or '')
+    if strong:
+        return strong
+    weak = weak_terms.findall(question or '')
+    if weak and (context_terms.search(question or '') or context_terms.search(summary or '')):
+        return weak
+    return []
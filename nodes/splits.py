@@ -0,0 +1,45 @@
+import pickle
+import hashlib
+from langchain_core.documents import Document
+from langchain_text_splitters import MarkdownHeaderTextSplitter
+
+# Splitting a guideline chunk into its header sections. Kept free of models and stores so the offline
+# build (build_index.py) can use it without loading the serving side.
+
+headers_to_split_on = [
+    ("#", "Title"),
+    ("##", "Header 1"),
+    ("###", "Header 2"),
+    ("####", "Header 3"),
+    ("#####", "Header 4"),
+    ("######", "Header 5"),
+    ("#######", "Header 6")
+]
+
+markdown_splitter_with_header = MarkdownHeaderTextSplitter(
+    headers_to_split_on=headers_to_split_on,
+    strip_headers=False
+    )
+
+def split_id(split: Document):
+    # content addressed, so ids stay stable across rebuilds as long as the split itself is unchanged
+    key = f'{sorted(split.metadata.items())}\n{split.page_content}'
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def split_document(document: Document):
+    # split docs and integrate metadata
+    split_docs = markdown_splitter_with_header.split_text(document.page_content)
+    for s in split_docs:
+        s.metadata = {**document.metadata, **{k: v for k, v in s.metadata.items() if k not in document.metadata}}
+        s.id = split_id(s)
+    return split_docs
+
+def build_splits(pickle_directory):
+    with open(f'guideline_pkls/{pickle_directory}/doc_ids.pkl', 'rb') as file:
+        doc_ids = pickle.load(file)
+    with open(f'guideline_pkls/{pickle_directory}/docs.pkl', 'rb') as file:
+        docs = pickle.load(file)
+    splits = {doc_id: split_document(d) for doc_id, d in zip(doc_ids, docs)}
+    with open(f'guideline_pkls/{pickle_directory}/splits.pkl', 'wb') as file:
+        pickle.dump(splits, file)
+    return splits
@@ -0,0 +1,93 @@
+from contextvars import ContextVar
+from langchain_core.pydantic_v1 import root_validator
+from langchain_openai import ChatOpenAI as _ChatOpenAI
+
+# langchain_openai keeps only the prompt/completion token counts of each response; the number of prompt
+# tokens OpenAI served from its prompt cache (usage.prompt_tokens_details.cached_tokens) is read here
+# off the raw responses and added to the message's response_metadata as 'cached_tokens'.
+
+_usage: ContextVar[dict] = ContextVar('openai_usage')
+
+
+def cached_tokens(usage) -> int:
+    if usage is None:
+        return 0
+    if not isinstance(usage, dict):
+        usage = usage.model_dump()
+    return (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+
+
+class _Stream(object):
+    def __init__(self, stream, usage: dict) -> None:
+        self._stream = stream
+        self._usage = usage
+
+    async def __aenter__(self):
+        await self._stream.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return await self._stream.__aexit__(*exc_info)
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            if getattr(chunk, 'usage', None):  # the last chunk, with stream_usage=True
+                self._usage['cached_tokens'] = cached_tokens(chunk.usage)
+            yield chunk
+
+
+class _Completions(object):
+    """ Wraps the openai chat completions resource, noting the cached tokens of the call in progress """
+    def __init__(self, completions) -> None:
+        self._completions = completions
+
+    def __getattr__(self, name):
+        return getattr(self._completions, name)
+
+    async def create(self, **payload):
+        response = await self._completions.create(**payload)
+        usage = _usage.get(None)
+        if usage is None:
+            return response
+        if payload.get('stream'):
+            return _Stream(response, usage)
+        usage['cached_tokens'] = cached_tokens(response.usage)
+        return response
+
+
+class ChatOpenAI(_ChatOpenAI):
+    """ ChatOpenAI that also reports the prompt tokens OpenAI served from its prompt cache """
+
+    @root_validator(pre=False, skip_on_failure=True)
+    def _report_cached_tokens(cls, values: dict) -> dict:
+        if not isinstance(values['async_client'], _Completions):
+            values['async_client'] = _Completions(values['async_client'])
+        return values
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        usage = {}
+        token = _usage.set(usage)
+        try:
+            result = await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        finally:
+            _usage.reset(token)
+        for generation in result.generations:
+            # with streaming=True the count was already set by _astream
+            generation.message.response_metadata.setdefault('cached_tokens', usage.get('cached_tokens', 0))
+        return result
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        # called directly, not through _agenerate, whenever a streaming callback handler is attached
+        usage = {}
+        chunks = super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs)
+        token = _usage.set(usage)
+        try:
+            chunk = await anext(chunks, None)
+        finally:
+            # the request has been made by now, and its stream holds on to `usage`
+            _usage.reset(token)
+        while chunk is not None:
+            if chunk.message.usage_metadata:
+                chunk.message.response_metadata['cached_tokens'] = usage.get('cached_tokens', 0)
+            yield chunk
+            chunk = await anext(chunks, None)
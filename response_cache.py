@@ -0,0 +1,84 @@
+import glob
+import asyncio
+import hashlib
+import uuid
+import numpy as np
+
+from caching import LRUCache, SQLiteCache, encode_vector, decode_vector
+from nodes.query_embeddings import aembed_queries
+from constants import RESPONSE_CACHE_THRESHOLD, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_PATH
+
+# anything an answer depends on: the guideline stores, the prompt templates (which live in these sources),
+# the models and thresholds in constants.py, and the streaming protocol the stored events are in
+FINGERPRINTED_FILES = ['guideline_pkls/**/*', 'template.py', 'main_graph.py', 'nodes/*.py', 'constants.py', 'api.py']
+
+
+def corpus_fingerprint():
+    sha = hashlib.sha256()
+    paths = sorted({p for pattern in FINGERPRINTED_FILES for p in glob.glob(pattern, recursive=True)})
+    for path in paths:
+        if path.endswith('.DS_Store'):
+            continue
+        try:
+            with open(path, 'rb') as file:
+                sha.update(path.encode())
+                sha.update(file.read())
+        except IsADirectoryError:
+            pass
+    return sha.hexdigest()
+
+
+class SemanticResponseCache(object):
+    """ Stored /chat event streams, looked up by nearest-neighbour prompt embedding
+
+    Entries are searched in memory; with a path, each one is also written to SQLite as it's stored,
+    and the current ones are read back in at startup.
+    """
+    def __init__(self, threshold=RESPONSE_CACHE_THRESHOLD, max_entries=RESPONSE_CACHE_MAX_ENTRIES, path=RESPONSE_CACHE_PATH) -> None:
+        self.threshold = threshold
+        self.fingerprint = corpus_fingerprint()
+        self.entries = LRUCache(max_entries)
+        self.disk = SQLiteCache(path, max_entries, table='responses') if path else None
+        if self.disk is not None:
+            # entries built against other guidelines or prompts are stale
+            stale = []
+            for key, entry in self.disk.items():
+                if entry['fingerprint'] != self.fingerprint:
+                    stale.append(key)
+                else:
+                    self.entries.set(key, {**entry, 'vector': decode_vector(entry['vector'])})
+            self.disk.delete_many(stale)
+
+    async def alookup(self, prompt: str, summary: str):
+        """ Events of the closest stored answer to the same conversation, if it's similar enough """
+        entries = [(k, e) for k, e in self.entries.items() if e['summary'] == _normalize(summary)]
+        if not entries:
+            return None
+        vector, = await aembed_queries([prompt])
+        vector = vector / np.linalg.norm(vector)
+        similarities = np.stack([e['vector'] for _, e in entries]) @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+        key, entry = entries[best]
+        self.entries.get(key)  # mark as recently used
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.get, key)
+        return entry['events']
+
+    async def astore(self, prompt: str, summary: str, events: list[dict]):
+        vector, = await aembed_queries([prompt])
+        key = uuid.uuid4().hex
+        entry = {
+            'vector': vector / np.linalg.norm(vector),
+            'summary': _normalize(summary),
+            'events': events,
+            'fingerprint': self.fingerprint
+        }
+        self.entries.set(key, entry)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.set, key, {**entry, 'vector': encode_vector(entry['vector'])})
+
+
+def _normalize(text: str):
+    return ' '.join((text or '').split())
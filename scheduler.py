@@ -0,0 +1,257 @@
+import time
+import heapq
+import random
+import asyncio
+import itertools
+from typing import Any, Awaitable, Callable, Optional
+import openai
+from langchain_core.pydantic_v1 import Field, root_validator
+from langchain_openai import OpenAIEmbeddings
+
+from openai_usage import ChatOpenAI
+from metrics import metrics
+
+# Every outbound OpenAI request waits here for its model's request and token budgets (token buckets),
+# queued by priority, so bulk work (doc filter fan-out, summaries) can't starve the chat stream.
+# A 429 pauses the whole model for a jittered, exponentially growing delay before the call is retried
+# in its original place in the queue. The SDK's own retries are off (max_retries=0), since they'd go
+# around the queue. Budgets are per process.
+
+# queue priorities, lowest first
+CHAT, INTERACTIVE, BULK = 0, 1, 2
+PRIORITY_NAMES = {CHAT: 'chat', INTERACTIVE: 'interactive', BULK: 'bulk'}
+
+CHARS_PER_TOKEN = 4
+COMPLETION_TOKENS_ESTIMATE = 500  # reserved for the completion when max_tokens isn't set; settled on the actual usage
+
+
+class TokenBucket(object):
+    """ Holds up to `per_minute` units, refilled continuously at `per_minute` a minute; may run into debt """
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait(self, amount: float) -> float:
+        """ Seconds until `amount` is available (anything over capacity only waits for a full bucket) """
+        self._refill()
+        return max(0., (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.level -= amount
+
+    def give(self, amount: float) -> None:
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class ModelLimiter(object):
+    """ Priority queue in front of one model's request and token budgets """
+    def __init__(self, name: str, scheduler: 'Scheduler', requests_per_minute: float = None, tokens_per_minute: float = None) -> None:
+        self.name = name
+        self.scheduler = scheduler
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.paused_until = 0.
+        self._queue = []  # (priority, order, tokens, enqueued, future)
+        self._order = itertools.count()
+        self._timer = None
+
+    def _wait(self, tokens: int) -> float:
+        waits = [self.paused_until - time.monotonic()]
+        if self.requests:
+            waits.append(self.requests.wait(1))
+        if self.tokens:
+            waits.append(self.tokens.wait(tokens))
+        return max(waits)
+
+    def _dispatch(self):
+        self._timer = None
+        while self._queue:
+            priority, _, tokens, enqueued, future = self._queue[0]
+            if future.done():  # the caller went away
+                heapq.heappop(self._queue)
+                continue
+            wait = self._wait(tokens)
+            if wait > 0:
+                self._timer = future.get_loop().call_later(wait, self._dispatch)
+                return
+            heapq.heappop(self._queue)
+            if self.requests:
+                self.requests.take(1)
+            if self.tokens:
+                self.tokens.take(tokens)
+            waited = time.monotonic() - enqueued
+            metrics.incr(f'scheduler.{self.name}.calls')
+            metrics.incr(f'scheduler.{self.name}.wait_seconds', waited)
+            metrics.incr(f'scheduler.{self.name}.wait_seconds.{PRIORITY_NAMES.get(priority, priority)}', waited)
+            future.set_result(None)
+
+    async def acquire(self, tokens: int, priority: int = INTERACTIVE, order: int = None):
+        """ Waits for this call's turn and its share of the budgets """
+        future = asyncio.get_running_loop().create_future()
+        order = next(self._order) if order is None else order
+        heapq.heappush(self._queue, (priority, order, tokens, time.monotonic(), future))
+        if self._timer is not None:
+            self._timer.cancel()
+        self._dispatch()
+        await future
+
+    def settle(self, reserved: int, used: int) -> None:
+        """ Corrects the token budget once a call's actual usage is known """
+        if self.tokens:
+            self.tokens.give(reserved - used)
+
+    def pause(self, attempt: int, retry_after: float = None) -> float:
+        delay = self.scheduler.backoff(attempt)
+        delay = max(delay, retry_after or 0.)
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        return delay
+
+    async def run(self, call: Callable[[], Awaitable], tokens: int, priority: int = INTERACTIVE):
+        """ `call()` once it's this call's turn, retried on rate limits and transient errors """
+        order = next(self._order)
+        for attempt in itertools.count():
+            await self.acquire(tokens, priority, order)
+            try:
+                return await call()
+            except openai.RateLimitError as e:
+                self.settle(tokens, 0)
+                metrics.incr(f'scheduler.{self.name}.rate_limited')
+                if attempt >= self.scheduler.retries:
+                    raise
+                self.pause(attempt, retry_after(e))
+            except (openai.APIConnectionError, openai.InternalServerError):
+                self.settle(tokens, 0)
+                if attempt >= self.scheduler.retries:
+                    raise
+                await asyncio.sleep(self.scheduler.backoff(attempt))
+            metrics.incr(f'scheduler.{self.name}.retries')
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        waiting = [(p, enqueued) for p, _, _, enqueued, f in self._queue if not f.done()]
+        stats = {
+            f'scheduler.{self.name}.queued': len(waiting),
+            f'scheduler.{self.name}.oldest_wait_seconds': max((now - e for _, e in waiting), default=0.),
+            f'scheduler.{self.name}.paused_seconds': max(0., self.paused_until - now),
+        }
+        for priority, name in PRIORITY_NAMES.items():
+            stats[f'scheduler.{self.name}.queued.{name}'] = sum(p == priority for p, _ in waiting)
+        return stats
+
+
+class Scheduler(object):
+    """ One ModelLimiter per model; `limits` maps model names to requests_per_minute / tokens_per_minute """
+    def __init__(self, limits: dict = None, retries: int = 6, backoff_seconds: float = 1., backoff_max_seconds: float = 60.) -> None:
+        self.limits = limits or {}
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.limiters = {}
+
+    def limiter(self, model: str) -> ModelLimiter:
+        if model not in self.limiters:
+            self.limiters[model] = ModelLimiter(model, self, **self.limits.get(model, {}))
+        return self.limiters[model]
+
+    def backoff(self, attempt: int) -> float:
+        # jittered, so callers that failed together don't all come back together
+        delay = min(self.backoff_max_seconds, self.backoff_seconds * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def snapshot(self) -> dict:
+        """ Queue depths, served on /metrics alongside the counters """
+        return {k: v for limiter in self.limiters.values() for k, v in limiter.snapshot().items()}
+
+
+def retry_after(error: openai.APIStatusError) -> Optional[float]:
+    try:
+        return float(error.response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def estimate_tokens(payload: dict) -> int:
+    """ Rough token count of a chat completion or embeddings request, completion included """
+    if 'messages' in payload:
+        chars = sum(len(str(m.get('content') or '')) for m in payload['messages'])
+        return chars // CHARS_PER_TOKEN + 4 * len(payload['messages']) + (payload.get('max_tokens') or COMPLETION_TOKENS_ESTIMATE)
+    inputs = payload.get('input')
+    inputs = [inputs] if isinstance(inputs, str) else inputs or []
+    return sum(len(i) if isinstance(i, list) else len(i) // CHARS_PER_TOKEN + 1 for i in inputs)
+
+
+class _SettlingStream(object):
+    def __init__(self, stream, limiter: ModelLimiter, reserved: int) -> None:
+        self._stream = stream
+        self._limiter = limiter
+        self._reserved = reserved
+
+    async def __aenter__(self):
+        await self._stream.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return await self._stream.__aexit__(*exc_info)
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            if getattr(chunk, 'usage', None):
+                self._limiter.settle(self._reserved, chunk.usage.total_tokens)
+            yield chunk
+
+
+class _ScheduledResource(object):
+    """ Wraps an openai resource (chat completions, embeddings) so its create() goes through the scheduler """
+    def __init__(self, resource, scheduler: Scheduler, priority: int) -> None:
+        self._resource = resource
+        self._scheduler = scheduler
+        self._priority = priority
+
+    def __getattr__(self, name):
+        return getattr(self._resource, name)
+
+    async def create(self, **payload):
+        limiter = self._scheduler.limiter(payload['model'])
+        reserved = estimate_tokens(payload)
+        response = await limiter.run(lambda: self._resource.create(**payload), reserved, self._priority)
+        if payload.get('stream'):
+            return _SettlingStream(response, limiter, reserved)
+        if getattr(response, 'usage', None):
+            limiter.settle(reserved, response.usage.total_tokens)
+        return response
+
+
+def _schedule(values: dict) -> dict:
+    if values['scheduler'] is not None and not isinstance(values['async_client'], _ScheduledResource):
+        values['async_client'] = _ScheduledResource(values['async_client'], values['scheduler'], values['priority'])
+    return values
+
+
+class ScheduledChatOpenAI(ChatOpenAI):
+    """ ChatOpenAI whose async requests wait their turn in `scheduler` """
+    scheduler: Any = Field(default=None, exclude=True)
+    priority: int = INTERACTIVE
+    max_retries: int = 0
+
+    @root_validator(pre=False, skip_on_failure=True)
+    def _schedule_requests(cls, values: dict) -> dict:
+        return _schedule(values)
+
+
+class ScheduledOpenAIEmbeddings(OpenAIEmbeddings):
+    """ OpenAIEmbeddings whose async requests wait their turn in `scheduler` """
+    scheduler: Any = Field(default=None, exclude=True)
+    priority: int = INTERACTIVE
+    max_retries: int = 0
+
+    @root_validator(pre=False, skip_on_failure=True)
+    def _schedule_requests(cls, values: dict) -> dict:
+        return _schedule(values)
@@ -0,0 +1,65 @@
+import asyncio
+from typing import AsyncIterator, Callable, Hashable
+
+
+class Flight(object):
+    """ One running event stream, broadcast to every subscriber; late joiners get the buffered events first """
+    def __init__(self, events: AsyncIterator, on_cancel: Callable = None) -> None:
+        self.events = []
+        self.subscribers = 0
+        self.on_cancel = on_cancel
+        # follow-up work on the stream's result, done once and shared by every subscriber
+        self.shared = {}
+        self._changed = asyncio.Event()
+        self._task = asyncio.create_task(self._run(events))
+
+    async def _run(self, events: AsyncIterator):
+        try:
+            async for event in events:
+                self.events.append(event)
+                self._notify()
+        finally:
+            self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    @property
+    def done(self):
+        return self._task.done()
+
+    async def next(self, index: int, timeout: float = None):
+        """ The event at `index`, waiting up to `timeout` for it; raises StopAsyncIteration once the stream has ended """
+        if index >= len(self.events) and not self.done:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        if index < len(self.events):
+            return self.events[index]
+        if self.done:
+            self._task.result()  # re-raise anything the stream raised
+            raise StopAsyncIteration
+        return await self.next(index, timeout)
+
+    def leave(self):
+        # the work is only abandoned once nobody is listening
+        self.subscribers -= 1
+        if self.subscribers == 0 and not self.done:
+            self._task.cancel()
+            if self.on_cancel is not None:
+                self.on_cancel()
+
+
+class SingleFlight(object):
+    """ Runs at most one event stream per key; concurrent callers with the same key share it """
+    def __init__(self) -> None:
+        self.flights = {}
+
+    def join(self, key: Hashable, events: Callable[[], AsyncIterator], on_cancel: Callable = None):
+        """ Subscribe to the running flight for `key`, starting `events()` if there isn't one; returns (flight, joined) """
+        flight = self.flights.get(key)
+        joined = flight is not None
+        if not joined:
+            flight = self.flights[key] = Flight(events(), on_cancel)
+            flight._task.add_done_callback(lambda _: self.flights.pop(key, None) if self.flights.get(key) is flight else None)
+        flight.subscribers += 1
+        return flight, joined
@@ -0,0 +1,36 @@
+import asyncio
+from typing import Awaitable
+
+from caching import LRUCache
+from constants import SUMMARY_STORE_SIZE, SUMMARY_SHUTDOWN_SECONDS
+
+
+class ConversationSummaries(object):
+    """ Conversation summaries, generated in the background after each answer and fetched by conversation id """
+    def __init__(self, maxsize: int = SUMMARY_STORE_SIZE) -> None:
+        self.tasks = LRUCache(maxsize)
+        # unfinished ones, including any the LRU has already evicted
+        self.pending = set()
+
+    def start(self, conversation_id: str, summary: Awaitable[str]):
+        task = asyncio.ensure_future(summary)
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+        self.tasks.set(conversation_id, task)
+
+    async def get(self, conversation_id: str):
+        """ The latest summary of the conversation, waiting for it if it's still being written; None if unknown """
+        task = self.tasks.get(conversation_id)
+        if task is None:
+            return None
+        # a client giving up on the wait shouldn't cancel the summary for everyone else
+        return await asyncio.shield(task)
+
+    async def drain(self, timeout: float = SUMMARY_SHUTDOWN_SECONDS):
+        """ Wait for the summaries still being written, cancelling whatever isn't done after `timeout` seconds """
+        if not self.pending:
+            return
+        _, unfinished = await asyncio.wait(set(self.pending), timeout=timeout)
+        for task in unfinished:
+            task.cancel()
+        await asyncio.gather(*unfinished, return_exceptions=True)
@@ -15,15 +15,7 @@ Return only the following 3 items in the template below. Be inclusive but concis
 "Last topics discussed": "what topics have been discussed? If any treatments were mentioned, list them in your summary in order of discussion"""
 
 template = \
-"""BACKGROUND:
-The following context, retrieved from a large knowledge base on BPH, is provided to help you answer the user's questions about BPH:
-
-{context}
-
-Prostate size ranges: <30mL, Enlarged (30-80mL), Very enlarged (80-150mL), Extremely enlarged (>150 mL)
-END OF BACKGROUND
-
-INSTRUCTIONS:
+"""INSTRUCTIONS:
 Your MAIN GOAL is to have a normal conversation with the user.
 Answer the USER's query. Focus on BPH only. Refuse politely but firmly to discuss any other topic.
 Answer questions using ONLY the supplied information.
@@ -41,6 +33,15 @@ Remember: answer using ONLY the BACKGROUND INFORMATION supplied in this prompt.
 FINALLY: pay EXTRA ATTENTION to any TABLES, FIGURES, or ALGORITHMS in the BACKGROUND to help validate your answer.
 Do NOT make reference to the BACKGROUND INFORMATION in your answer."""
 
+context_template = \
+"""BACKGROUND:
+The following context, retrieved from a large knowledge base on BPH, is provided to help you answer the user's questions about BPH:
+
+{context}
+
+Prostate size ranges: <30mL, Enlarged (30-80mL), Very enlarged (80-150mL), Extremely enlarged (>150 mL)
+END OF BACKGROUND"""
+
 
 
 surg_abbrevs_table = \
@@ -128,4 +129,29 @@ other_abbrevs_table = \
 |RE|Retrograde Ejaculation|
 |TRUS|Transurethral Ultrasound|
 |UTI|Urinary Tract Infection|
-|WW|Watchful Waiting|"""
\ No newline at end of file
+|WW|Watchful Waiting|"""
+
+
+# --- static prompt prefixes ---
+# Providers cache the longest previously seen prompt prefix, so everything that's the same on every call
+# goes first, verbatim, and per-request content (summary, query, documents) after it.
+
+# opens the system prompt of the router, query generators, doc filter and fused query understanding
+abbreviations_prefix = \
+f"""ABBREVIATIONS
+
+{meds_abbrevs_table}
+
+{surg_abbrevs_table}
+
+{other_abbrevs_table}
+END OF ABBREVIATIONS"""
+
+# follows `template` in the chat prompt whenever the guidelines are used
+guideline_template = \
+f"""Since different guidelines use different terms to refer to the same treatment, always unify them using this reference table:
+
+{surg_abbrevs_table}
+
+You should try to combine the information from each guideline where possible, highlighting only major differences as you go, if applicable.
+You should give a brief comparison between the guidelines (CUA, AUA, EAU), at the end of your response."""
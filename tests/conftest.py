@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the modules under test build their OpenAI clients at import time; no requests are made
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,55 @@
+import pytest
+
+from nodes.algoreader import extract_size, extract_features
+
+
+@pytest.mark.parametrize('text, bucket', [
+    ('My prostate is 65cc', '30-80cc'),
+    ('65 cc prostate', '30-80cc'),
+    ('TRUS showed 45 g', '30-80cc'),
+    ('my gland is 25 ml', '<30cc'),
+    ('prostate volume > 100 ml', '>80cc'),
+    ('prostate of 60 cc, PVR 150 ml', '30-80cc'),
+])
+def test_prostate_volume(text, bucket):
+    assert extract_size(text) == ({bucket}, False)
+
+
+@pytest.mark.parametrize('text', [
+    'My PVR is 150 mL',
+    'Qmax 8 ml/s',
+    'I drink 2000 ml of water a day',
+    '100 ml bladder capacity',
+    'I voided 150 ml',
+])
+def test_other_volumes_are_not_prostate_size(text):
+    assert extract_size(text) == (set(), False)
+    assert extract_features(text)['size'] == 'None'
+
+
+@pytest.mark.parametrize('text', [
+    'what about 90g?',
+    'prostate 60cc and PVR 150 ml',
+])
+def test_ambiguous_volume_goes_to_the_llm(text):
+    assert extract_features(text) is None
+
+
+def test_summary_fills_in_size():
+    assert extract_features('Which surgery?', 'Patient with a 90 cc prostate')['size'] == '>80cc'
+
+
+@pytest.mark.parametrize('text', [
+    "I'm aspirin-free",
+    'aspirin free since last year',
+    'anticoagulant-free for a month',
+    'I am on a non-aspirin painkiller',
+    'free of blood thinners',
+    'not on aspirin',
+])
+def test_negated_bleeding_cue_goes_to_the_llm(text):
+    assert extract_features(f'My prostate is 50cc. {text}') is None
+
+
+def test_bleeding_cue():
+    assert extract_features('My prostate is 50cc. I take aspirin every morning')['q_b'] is True
@@ -0,0 +1,44 @@
+from langchain_core.documents import Document
+
+import nodes.context_packer as context_packer
+from nodes.context_packer import pack_context, DOCUMENT_OVERHEAD_TOKENS
+
+
+def document(doc_id: str, *texts: str, confidence: float = 1.):
+    return Document(page_content=' '.join(texts), metadata={'Title': ''}, id=doc_id), [(Document(page_content=t), confidence) for t in texts]
+
+
+def words(prefix: str, count: int = 10):
+    return ' '.join(f'{prefix}{n}' for n in range(count))
+
+
+def pack(monkeypatch, documents, scores, budget):
+    monkeypatch.setattr(context_packer, 'count_tokens', lambda text: len(text.split()))
+    return pack_context([d for d, _ in documents], [s for _, s in documents], scores, budget)
+
+
+def test_budget(monkeypatch):
+    documents = [document('a', words('a'), words('b')), document('b', words('c'))]
+    budget = DOCUMENT_OVERHEAD_TOKENS + 20
+    packed, stats = pack(monkeypatch, documents, {'a': 1., 'b': 0.5}, budget)
+    assert [d.id for d in packed] == ['a']
+    assert stats['tokens'] == budget
+    assert stats['over_budget'] == 1
+    assert stats['tokens'] <= stats['budget']
+
+
+def test_duplicates_dropped(monkeypatch):
+    shared = words('x')
+    documents = [document('a', shared), document('b', shared + ' extra', words('y'))]
+    packed, stats = pack(monkeypatch, documents, {'a': 1., 'b': 0.9}, 1000)
+    assert stats['duplicates'] == 1
+    assert [d.page_content for d in packed] == [shared, words('y')]
+
+
+def test_source_order(monkeypatch):
+    # the later split scores higher but still follows the earlier one in the packed document
+    documents = [document('a', words('first'), confidence=0.2), document('b', words('second'))]
+    documents[0][1].append((Document(page_content=words('last')), 0.9))
+    packed, _ = pack(monkeypatch, documents, {'a': 1., 'b': 0.5}, 1000)
+    assert [d.id for d in packed] == ['a', 'b']  # 'a' ranks by its best split (0.9 > 0.5)
+    assert packed[0].page_content == words('first') + '\n\n' + words('last')
@@ -0,0 +1,54 @@
+import asyncio
+
+from langchain_core.documents import Document
+from langchain_core.runnables import RunnableLambda
+
+import nodes.llm_doc_filter as doc_filter
+
+DOCUMENT = Document(page_content='## A\naaa\n### B\nbbb\n### C\nccc\n### D\nddd', metadata={'Title': 'T'}, id='d1')
+
+
+def name(split):
+    # the split's header letter
+    return split.page_content.split()[1]
+
+
+def run_filter(monkeypatch, scores, metadata_yes, full_text_yes, prefilter=True):
+    judged = {'metadata': [], 'full_text': []}
+
+    async def prefilter_scores(queries_dict, splits):
+        return [scores[name(s)] for s in splits]
+
+    async def classify(question, splits, contents, filter_pass, stats):
+        names = [name(s) for s in splits]
+        judged[filter_pass].extend(names)
+        return [n in (metadata_yes if filter_pass == 'metadata' else full_text_yes) for n in names]
+
+    async def compress(_input):
+        return _input['document']
+
+    monkeypatch.setattr(doc_filter, 'FILTER_PREFILTER_ENABLED', prefilter)
+    monkeypatch.setattr(doc_filter, 'get_splits', doc_filter.split_document)
+    monkeypatch.setattr(doc_filter, 'prefilter_scores', prefilter_scores)
+    monkeypatch.setattr(doc_filter, 'cached_classify_relevance', classify)
+    monkeypatch.setattr(doc_filter, 'compressor_chain', RunnableLambda(compress))
+    filtered, stats, kept = asyncio.run(doc_filter.filter_documents([DOCUMENT], {'rephrased': 'q'}))
+    return filtered, stats, kept, judged
+
+
+def test_similarity_bands(monkeypatch):
+    # A above ACCEPT, B below REJECT, C in between, D without an embedding
+    scores = {'A': 0.9, 'B': 0.1, 'C': 0.5, 'D': None}
+    filtered, stats, kept, judged = run_filter(monkeypatch, scores, metadata_yes={'C'}, full_text_yes={'D'})
+    assert (stats['auto_accepted'], stats['auto_rejected'], stats['llm_judged']) == (1, 1, 2)
+    assert judged == {'metadata': ['C', 'D'], 'full_text': ['D']}
+    assert [(name(s), confidence) for s, confidence in kept[0]] == [('A', 1.0), ('C', 0.8), ('D', 0.6)]
+    assert 'bbb' not in filtered[0].page_content
+
+
+def test_prefilter_off_sends_every_split_to_the_llm(monkeypatch):
+    scores = {'A': 0.9, 'B': 0.1, 'C': 0.5, 'D': None}
+    _, stats, kept, judged = run_filter(monkeypatch, scores, metadata_yes={'A', 'B'}, full_text_yes=set(), prefilter=False)
+    assert (stats['auto_accepted'], stats['auto_rejected'], stats['llm_judged']) == (0, 0, 4)
+    assert judged['metadata'] == ['A', 'B', 'C', 'D']
+    assert [name(s) for s, _ in kept[0]] == ['A', 'B']
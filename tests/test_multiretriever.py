@@ -0,0 +1,22 @@
+import pytest
+from langchain_core.documents import Document
+
+from nodes.multiretriever import reciprocal_rank_fusion
+
+
+def test_rrf_dedupes_by_id():
+    # the same docstore entry retrieved twice, once with different content (e.g. reloaded), counts once
+    a = Document(page_content='a', id='1')
+    a_again = Document(page_content='a, reloaded', id='1')
+    b = Document(page_content='b', id='2')
+    fused = reciprocal_rank_fusion([[a, b], [a_again]], k=60)
+    assert [d.id for d, _ in fused] == ['1', '2']
+    assert fused[0][0] is a
+    assert fused[0][1] == pytest.approx(2 / 60)
+    assert fused[1][1] == pytest.approx(1 / 61)
+
+
+def test_rrf_without_ids():
+    # documents without an id fall back to their content, so distinct ones are never merged
+    fused = reciprocal_rank_fusion([[Document(page_content='a'), Document(page_content='b')], [Document(page_content='a')]])
+    assert [d.page_content for d, _ in fused] == ['a', 'b']
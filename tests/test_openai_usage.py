@@ -0,0 +1,71 @@
+import asyncio
+
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+from langchain_core.prompts import ChatPromptTemplate
+
+from openai_usage import ChatOpenAI
+from metrics import TokenUsage
+
+USAGE = {'prompt_tokens': 1500, 'completion_tokens': 2, 'total_tokens': 1502, 'prompt_tokens_details': {'cached_tokens': 1280}}
+BASE = {'id': 'x', 'created': 0, 'model': 'gpt-4o-mini'}
+
+
+class FakeStream(object):
+    def __init__(self, chunks) -> None:
+        self.chunks = chunks
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+class FakeCompletions(object):
+    async def create(self, **payload):
+        if not payload.get('stream'):
+            return ChatCompletion(**BASE, object='chat.completion', usage=USAGE, choices=[
+                {'index': 0, 'message': {'role': 'assistant', 'content': 'hi'}, 'finish_reason': 'stop'}])
+        chunk = {**BASE, 'object': 'chat.completion.chunk'}
+        return FakeStream([
+            ChatCompletionChunk(**chunk, choices=[{'index': 0, 'delta': {'role': 'assistant', 'content': 'hi'}, 'finish_reason': None}]),
+            ChatCompletionChunk(**chunk, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]),
+            ChatCompletionChunk(**chunk, choices=[], usage=USAGE),
+        ])
+
+
+def fake_chain(**kwargs):
+    llm = ChatOpenAI(model='gpt-4o-mini', api_key='test', stream_usage=True, **kwargs)
+    llm.async_client._completions = FakeCompletions()
+    return ChatPromptTemplate.from_messages([('human', '{q}')]) | llm
+
+
+def test_cached_tokens_on_invoke():
+    usage = TokenUsage()
+    message = asyncio.run(fake_chain().ainvoke({'q': 'a'}, {'callbacks': [usage]}))
+    assert message.response_metadata['cached_tokens'] == 1280
+    assert usage.report()['input_cached'] == 1280
+
+
+def test_cached_tokens_with_streaming_model():
+    usage = TokenUsage()
+    message = asyncio.run(fake_chain(streaming=True).ainvoke({'q': 'a'}, {'callbacks': [usage]}))
+    assert message.response_metadata['cached_tokens'] == 1280
+    assert usage.report()['input_cached'] == 1280
+
+
+def test_cached_tokens_under_streaming_callback():
+    # astream_events attaches a streaming callback handler, so the model streams through _astream without _agenerate
+    usage = TokenUsage()
+
+    async def run():
+        return [e async for e in fake_chain().astream_events({'q': 'a'}, {'callbacks': [usage]}, version='v2')]
+
+    events = asyncio.run(run())
+    output = next(e for e in events if e['event'] == 'on_chat_model_end')['data']['output']
+    assert output.response_metadata['cached_tokens'] == 1280
+    assert usage.report()['input_cached'] == 1280
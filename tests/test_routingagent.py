@@ -0,0 +1,38 @@
+import pytest
+
+from nodes.routingagent import rule_route
+
+
+@pytest.mark.parametrize('question, summary', [
+    ('Is TURP painful?', ''),
+    ('Benign prostatic hyperplasia treatment options', ''),
+    ('Tell me about Rezum', ''),
+    ('What is my IPSS telling me?', ''),
+    ('I have BPH, should I take tamsulosin?', ''),
+    ('Is WAVE good for my enlarged prostate?', ''),
+    ('What about finasteride?', 'Patient with BPH and LUTS asking about medication'),
+    ('Is laser enucleation an option?', 'Patient with BPH, prostate of 90 cc'),
+    ('Does nocturia get better after surgery?', 'Discussed TURP for an enlarged prostate'),
+])
+def test_routes_bph_queries(question, summary):
+    assert rule_route(question, summary)
+
+
+@pytest.mark.parametrize('question', [
+    'greenlight for my project',
+    'laser vaporisation of warts',
+    'laser enucleation for kidney stones',
+    'urinary retention after childbirth',
+    'finasteride hair loss',
+    'tamsulosin for kidney stones',
+    'I wake up at night with nocturia',
+    'lower urinary tract infection',
+    'What is WAVE?',
+    'Is MIST safe?',
+    'prostate cancer screening',
+    'What is prostatitis?',
+    'What is my PSA?',
+    'UTI treatment',
+])
+def test_leaves_ambiguous_queries_to_the_llm(question):
+    assert rule_route(question, '') == []
@@ -0,0 +1,101 @@
+import time
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+from scheduler import Scheduler, TokenBucket, CHAT, INTERACTIVE, BULK
+
+
+def rate_limit_error(retry_after: str = None):
+    headers = {'retry-after': retry_after} if retry_after else {}
+    response = httpx.Response(429, headers=headers, request=httpx.Request('POST', 'https://api.openai.com/v1/chat/completions'))
+    return openai.RateLimitError('rate limited', response=response, body=None)
+
+
+def test_token_bucket():
+    bucket = TokenBucket(per_minute=600)
+    assert bucket.wait(600) == 0
+    bucket.take(600)
+    assert bucket.wait(10) == pytest.approx(1, abs=0.05)  # 10 units a second
+    assert bucket.wait(10_000) == pytest.approx(60, abs=0.05)  # never more than a full bucket
+    bucket.give(10_000)
+    assert bucket.level == 600
+
+
+def test_priority_order():
+    async def run():
+        limiter = Scheduler().limiter('model')
+        limiter.paused_until = time.monotonic() + 0.05
+        served = []
+
+        async def acquire(priority):
+            await limiter.acquire(1, priority)
+            served.append(priority)
+
+        await asyncio.gather(*[acquire(p) for p in (BULK, INTERACTIVE, CHAT)])
+        return served
+
+    assert asyncio.run(run()) == [CHAT, INTERACTIVE, BULK]
+
+
+def test_retry_keeps_its_place_in_the_queue():
+    async def run():
+        limiter = Scheduler({'model': {'requests_per_minute': 600}}, backoff_seconds=0.01).limiter('model')
+        limiter.requests.level = 1  # one request now, then one every 0.1s
+        started = []
+
+        async def first():
+            started.append('first')
+            if started.count('first') == 1:
+                await asyncio.sleep(0.02)  # 'second' queues up behind the exhausted budget meanwhile
+                raise rate_limit_error()
+
+        async def second():
+            started.append('second')
+
+        async def queue_second():
+            await asyncio.sleep(0.01)
+            await limiter.run(second, 1)
+
+        await asyncio.gather(limiter.run(first, 1), queue_second())
+        return started
+
+    assert asyncio.run(run()) == ['first', 'first', 'second']
+
+
+def test_retry_after_pauses_the_model():
+    async def run():
+        limiter = Scheduler(backoff_seconds=0.01).limiter('model')
+        attempts = []
+
+        async def call():
+            attempts.append(time.monotonic())
+            if len(attempts) == 1:
+                raise rate_limit_error('0.2')
+            return 'ok'
+
+        result = await limiter.run(call, 1)
+        return result, attempts, limiter
+
+    result, attempts, limiter = asyncio.run(run())
+    assert result == 'ok'
+    assert attempts[1] - attempts[0] >= 0.2
+    assert limiter.paused_until >= attempts[0] + 0.2
+
+
+def test_gives_up_after_the_retries():
+    async def run():
+        limiter = Scheduler(retries=2, backoff_seconds=0.001).limiter('model')
+        attempts = []
+
+        async def call():
+            attempts.append(1)
+            raise rate_limit_error()
+
+        with pytest.raises(openai.RateLimitError):
+            await limiter.run(call, 1)
+        return len(attempts)
+
+    assert asyncio.run(run()) == 3
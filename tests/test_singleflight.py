@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+async def numbers(count: int, delay: float = 0.01):
+    for n in range(count):
+        await asyncio.sleep(delay)
+        yield n
+
+
+async def drain(flight, timeout: float = 1):
+    received, index = [], 0
+    while True:
+        try:
+            received.append(await flight.next(index, timeout))
+        except StopAsyncIteration:
+            return received
+        index += 1
+
+
+def test_late_joiner_replay():
+    async def run():
+        flights = SingleFlight()
+        started = []
+
+        def events():
+            started.append(True)
+            return numbers(5)
+
+        first, joined = flights.join('key', events)
+        assert not joined
+        await first.next(2, 1)  # the stream is partway through before the second caller arrives
+        second, joined = flights.join('key', events)
+        assert joined and second is first
+
+        results = await asyncio.gather(drain(first), drain(second))
+        await asyncio.sleep(0)
+        return started, results, flights.flights
+
+    started, results, remaining = asyncio.run(run())
+    assert started == [True]
+    assert results == [[0, 1, 2, 3, 4], [0, 1, 2, 3, 4]]
+    assert remaining == {}
+
+
+def test_cancel_when_last_subscriber_leaves():
+    async def run():
+        flights = SingleFlight()
+        cancelled = []
+        first, _ = flights.join('key', lambda: numbers(100), on_cancel=lambda: cancelled.append(True))
+        second, _ = flights.join('key', lambda: numbers(100))
+        await first.next(0, 1)
+
+        first.leave()
+        await asyncio.sleep(0.02)
+        still_running = not second.done and not cancelled
+
+        second.leave()
+        with pytest.raises(asyncio.CancelledError):
+            await second._task
+        return still_running, cancelled, flights.flights
+
+    still_running, cancelled, remaining = asyncio.run(run())
+    assert still_running
+    assert cancelled == [True]
+    assert remaining == {}